@@ -1,12 +1,24 @@
 import logging
 import threading
-import schedule
 import atexit
 import pandas as pd
+from django.conf import settings
 try:
     from NYCT_tracker import NYCT_Tracker
+    from feed_scheduler import FeedScheduler
+    from feed_archive import FeedArchive
+    from feed_replay import FeedReplay
+    from feed_diff import SnapshotDiff, ChangeSet
+    from cancellations import CancellationDetector
+    from db_pool import ConnectionPool
 except ImportError:
     from .NYCT_tracker import NYCT_Tracker
+    from .feed_scheduler import FeedScheduler
+    from .feed_archive import FeedArchive
+    from .feed_replay import FeedReplay
+    from .feed_diff import SnapshotDiff, ChangeSet
+    from .cancellations import CancellationDetector
+    from .db_pool import ConnectionPool
 
 logger = logging.getLogger(__name__)
 
@@ -40,9 +52,67 @@ class _NYCT_Scraper(threading.Thread):
         self.latest_updates = pd.DataFrame()
         self.subscribers = []
         self.exit = threading.Event()
-        self.trk = NYCT_Tracker(None)
+        self.replay = None
+        # Database connections of this thread and the write-behind one
+        pool = ConnectionPool(
+                getattr(settings, 'NYCT_DB_POOL_SIZE', None),
+                getattr(settings, 'NYCT_DB_POOL_MAX_AGE',
+                        ConnectionPool.MAX_AGE),
+                getattr(settings, 'NYCT_DB_POOL_CHECK_INTERVAL', None))
+        if getattr(settings, 'NYCT_REPLAY_DIR', None):
+            # Play back archived feeds instead of polling the MTA
+            self.replay = FeedReplay(settings.NYCT_REPLAY_DIR,
+                                     getattr(settings, 'NYCT_REPLAY_SPEED',
+                                             1.0))
+            self.trk = NYCT_Tracker(
+                    '', concurrent=False,
+                    records=getattr(settings, 'NYCT_PARSE_RECORDS', False),
+                    columnar=getattr(settings, 'NYCT_PARSE_COLUMNS', False),
+                    wire=getattr(settings, 'NYCT_PARSE_WIRE', False),
+                    batch_size=getattr(settings, 'NYCT_STORE_BATCH_SIZE',
+                                       None),
+                    use_copy=getattr(settings, 'NYCT_STORE_COPY', True),
+                    write_behind=getattr(settings, 'NYCT_WRITE_BEHIND', None),
+                    write_queue=getattr(settings, 'NYCT_WRITE_QUEUE', None),
+                    write_rows=getattr(settings, 'NYCT_WRITE_ROWS', None),
+                    cdc=getattr(settings, 'NYCT_STORE_CDC', False),
+                    pool=pool)
+        else:
+            archive = None
+            if getattr(settings, 'NYCT_ARCHIVE_DIR', None):
+                archive = FeedArchive(
+                        settings.NYCT_ARCHIVE_DIR,
+                        max_bytes=getattr(settings, 'NYCT_ARCHIVE_MAX_BYTES',
+                                          None))
+            self.trk = NYCT_Tracker(
+                    None, archive=archive,
+                    baseurl=getattr(settings, 'NYCT_BASEURL', None),
+                    parse_workers=getattr(settings, 'NYCT_PARSE_WORKERS', 0),
+                    records=getattr(settings, 'NYCT_PARSE_RECORDS', False),
+                    columnar=getattr(settings, 'NYCT_PARSE_COLUMNS', False),
+                    wire=getattr(settings, 'NYCT_PARSE_WIRE', False),
+                    batch_size=getattr(settings, 'NYCT_STORE_BATCH_SIZE',
+                                       None),
+                    use_copy=getattr(settings, 'NYCT_STORE_COPY', True),
+                    write_behind=getattr(settings, 'NYCT_WRITE_BEHIND', None),
+                    write_queue=getattr(settings, 'NYCT_WRITE_QUEUE', None),
+                    write_rows=getattr(settings, 'NYCT_WRITE_ROWS', None),
+                    cdc=getattr(settings, 'NYCT_STORE_CDC', False),
+                    pool=pool)
+        # Most recent (trips, updates, other) of every line
+        self.latest_feeds = {}
+        # Lines whose entry in latest_feeds changed in the last update:
+        # subscribers may skip the others, they have seen them before
+        self.changed_feeds = set()
+        # ChangeSet of latest_trips/latest_updates against the snapshot
+        # before, for subscribers that only want to process what changed
+        self.differ = SnapshotDiff()
+        self.latest_changes = ChangeSet()
+        # {route_id: trip keys} of scheduled trips missing from the feeds
+        self.cancellations = None
+        self.latest_cancelled = {}
+        self.scheduler = FeedScheduler(self.trk.LINE_ID)
         atexit.register(self.stop)
-        schedule.every(30).seconds.do(self._trip_update)
         self.restart()
 
     def subscribe(self, func):
@@ -66,9 +136,28 @@ class _NYCT_Scraper(threading.Thread):
         self.running = False
         self.exit.set()
         self.join()
+        self.trk.close()
+
+    def _load_cancellations(self):
+        # Indexing the schedule takes a while, so it happens here on the
+        # scraper thread rather than in the constructor
+        if not getattr(settings, 'NYCT_DETECT_CANCELLATIONS', False):
+            return
+        try:
+            self.cancellations = CancellationDetector(
+                    self.trk.METADATA_PATH)
+        except:
+            logger.exception("Cancellation detection disabled")
 
     def run(self):
         self.running = True
+        self._load_cancellations()
+        # Connect now, rather than in the first cycle
+        self.trk.pool.warm()
+        if self.replay is not None:
+            self._replay()
+            self.trk.pool.close()
+            return
         try:
             # Manually kick off a trip update
             self._trip_update()
@@ -76,8 +165,11 @@ class _NYCT_Scraper(threading.Thread):
             logger.exception("")
         while self.running:
             try:
-                schedule.run_pending()
-                delay = schedule.idle_seconds()
+                # Lines with an open circuit wait for its cooldown
+                lines = self.scheduler.due(cooldown=self.trk.cooldown)
+                if lines:
+                    self._trip_update(lines)
+                delay = self.scheduler.idle_seconds()
                 # Enforce a minimum delay to avoid thrashing
                 if delay < 1.0:
                     self.exit.wait(1.0)
@@ -89,11 +181,73 @@ class _NYCT_Scraper(threading.Thread):
                 logger.exception("")
                 self.exit.wait(1.0)
                 continue
+        self.trk.pool.close()
+
+    def _replay(self):
+        lines = dict((v, k) for k, v in self.trk.LINE_ID.items())
+
+        def sink(feed_id, timestamp, payload):
+            line = lines[feed_id]
+            self._publish({line: self.trk.load_payload(line, payload)})
+        try:
+            self.replay.run(sink, self.exit)
+        except:
+            logger.exception("")
+
+    def _trip_update(self, lines=None):
+        feeds = self.trk.get_feeds(lines)
+        for line in feeds:
+            self.scheduler.update(line, self.trk.feed_timestamp.get(line))
+        # Failed or refused by their circuit breaker, not just late
+        fetching = self.trk.fetching
+        for line in (lines or self.trk.LINE_ID):
+            if line not in feeds and line not in fetching:
+                self.scheduler.failed(line)
+        try:
+            self.trk.store_failures()
+        except:
+            logger.exception("")
+        self._publish(feeds)
+        pool = self.trk.pool
+        logger.debug("Database pool: %d leases, waited %.1fms on average, "
+                     "%.1fms at most; %d connects in %.3fs, %d unusable",
+                     pool.leases, pool.mean_wait * 1000, pool.max_wait * 1000,
+                     pool.connects, pool.connect_time, pool.unusable)
+        writes = self.trk.write_behind
+        if writes is not None and (writes.dropped or writes.failed):
+            logger.warning("Write-behind: %d snapshots dropped, %d given up "
+                           "after %d retries, %d rows pending",
+                           writes.dropped, writes.failed, writes.retries,
+                           writes.pending_rows)
 
-    def _trip_update(self):
-        trips, updates, other = self.trk.get_all_trips()
+    def _publish(self, feeds):
+        changed = set()
+        for line, result in feeds.items():
+            if self.trk.feed_changed.get(line):
+                changed.add(line)
+            self.latest_feeds[line] = result
+        if not changed:
+            logger.debug("No new data from %s", ', '.join(feeds))
+            return
+        self.changed_feeds = changed
+        trips = []
+        updates = []
+        other = []
+        for line in self.trk.LINE_ID:
+            if line in self.latest_feeds:
+                line_trips, line_updates, line_other = self.latest_feeds[line]
+                trips += line_trips
+                updates += line_updates
+                other += line_other
         logger.debug("Got %d trips, %d updates, %d other",
                      len(trips), len(updates), len(other))
+        self.latest_changes = self.differ.diff(trips, updates)
+        if self.cancellations is not None:
+            periods = {}
+            for line in self.latest_feeds:
+                periods.update(self.trk.feed_periods.get(line, {}))
+            self.latest_cancelled = self.cancellations.detect(
+                    max(self.trk.feed_timestamp.values()), periods, trips)
         self.latest_trips = trips
         self.latest_updates = updates
         for func in self.subscribers:
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 # GTFS protobuf wrapper was generated using protoc and https://developers.google.com/transit/gtfs-realtime/gtfs-realtime.proto
 # The NYCT extensions to GTFS are also compiled from this protobuf: http://datamine.mta.info/sites/all/files/pdfs/nyct-subway.proto.txt
 try:
@@ -7,11 +8,32 @@ try:
 except ImportError:
     from . import gtfs_realtime_pb2
     from . import nyct_subway_pb2
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from google.protobuf.message import DecodeError
 import os
 import time
+import logging
+import threading
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 from sqlalchemy import create_engine
-from .models import Trip, Update
+from .models import Trip, Update, Failure
+from .circuit_breaker import CircuitBreaker
+from .feed_records import parse_records, parse_payload, \
+    replacement_periods
+from .feed_columns import TRIP_DTYPE, UPDATE_DTYPE, parse_columns
+from .symbols import SYMBOLS
+from .alerts import AlertIndex, alert_entities
+from .feed_wire import decode_payload
+from .snapshot_writer import SnapshotWriter
+from .write_behind import WriteBehind, DROP_OLDEST
+from .prediction_capture import PredictionCapture
+from .db_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
 
 
 def append_trip_info(trip):
@@ -35,8 +57,7 @@ def parse_feed(feed):
         if entity.HasField("vehicle"):
             trip_id = entity.vehicle.trip.trip_id
             if trip_id not in trips_raw:
-                trip = Trip(id="%s_%d" % (str(trip_id), feed_query_time),
-                            route_id=entity.vehicle.trip.route_id,
+                trip = Trip(route_id=entity.vehicle.trip.route_id,
                             trip_id=trip_id)
             else:
                 trip = trips_raw[trip_id]
@@ -53,15 +74,13 @@ def parse_feed(feed):
         elif entity.HasField("trip_update"):
             trip_id = entity.trip_update.trip.trip_id
             if trip_id not in trips_raw:
-                trip = Trip(id="%s_%d" % (str(trip_id), feed_query_time),
-                            route_id=entity.trip_update.trip.route_id,
+                trip = Trip(route_id=entity.trip_update.trip.route_id,
                             trip_id=trip_id)
             else:
                 trip = trips_raw[trip_id]
             for update in entity.trip_update.stop_time_update:
+                # parent_trip is filled in when stored, see SnapshotWriter
                 new_update = Update(
-                    id="%s_%s_%d" % (trip_id, update.stop_id, feed_query_time),
-                    parent_trip=trip,
                     trip_id=entity.trip_update.trip.trip_id,
                     arrival=update.arrival.time,
                     departure=update.departure.time,
@@ -100,6 +119,16 @@ def parse_feed(feed):
     return list(trips_raw.values()), updates_raw, unknown
 
 
+def records_to_models(trips, updates, unknown):
+    ''' Turn the records of feed_records.parse_records into the same
+    (trips, updates, other) that parse_feed returns '''
+    trips_raw = {}
+    for record in trips:
+        trips_raw[record.trip_id] = record.to_model()
+    updates_raw = [record.to_model() for record in updates]
+    return list(trips_raw.values()), updates_raw, unknown
+
+
 class NYCT_Tracker(object):
     # The following is from: http://datamine.mta.info/list-of-feeds
     LINE_ID = {
@@ -127,43 +156,382 @@ class NYCT_Tracker(object):
     }
     BASEURL = 'http://datamine.mta.info/mta_esi.php?key=%s&feed_id=%d'
     METADATA_PATH = 'metadata/'
+    # Minimum number of seconds between two requests to the same feed
+    POLITENESS = 0.250
+    # Seconds before a single request is given up on
+    TIMEOUT = 10.0
+    # Extra attempts after a failed request, the first one after BACKOFF
+    # seconds and every following one after twice as long as the last
+    RETRIES = 2
+    BACKOFF = 0.5
+    # Seconds get_feeds waits for slow feeds before returning without them;
+    # their results are returned by the next call instead
+    DEADLINE = 5.0
 
     def __init__(self, apikey, postgres_user='subway',
-                 postgres_password='subway', postgres_db='subway'):
+                 postgres_password='subway', postgres_db='subway',
+                 concurrent=True, max_workers=None, politeness=None,
+                 archive=None, baseurl=None, parse_workers=0,
+                 records=False, columnar=False, wire=False,
+                 batch_size=None, use_copy=True, write_behind=None,
+                 write_queue=None, cdc=False, pool=None, write_rows=None):
         if apikey is None:
             # Helper: Attempt to read APIKEY from disk
             with open('./mta_key.txt', 'r') as fil:
                 apikey = fil.read().strip()
         self.apikey = apikey
+        # Lets the tracker poll a stand-in server instead of the MTA
+        self.baseurl = baseurl or NYCT_Tracker.BASEURL
         self.shapes_clean = False
         self.last_trips_store = ''
         self.last_updates_store = ''
+        # Fetch all feeds in parallel from a bounded thread pool
+        self.concurrent = concurrent
+        self.max_workers = max_workers or len(self.LINE_ID)
+        self.politeness = politeness
+        if self.politeness is None:
+            self.politeness = NYCT_Tracker.POLITENESS
+        # Seconds taken by the most recent request, per line
+        self.feed_latency = {}
+        self.cycle_latency = 0.0
+        self._next_request = {}
+        self._request_lock = threading.Lock()
+        self._executor = None
+        # Fetches still running from an earlier get_feeds, per line
+        self._pending = {}
+        self.timeout = NYCT_Tracker.TIMEOUT
+        self.retries = NYCT_Tracker.RETRIES
+        self.deadline = NYCT_Tracker.DEADLINE
+        self.breakers = dict((line, CircuitBreaker(line))
+                             for line in self.LINE_ID)
+        # Failure instances waiting for store_failures()
+        self.failures = []
+        self._failures_lock = threading.Lock()
+        # Every database access of the tracker holds a lease of the pool
+        self.pool = pool or ConnectionPool()
+        # Bulk writes of trips and updates, see store_snapshot()
+        self.writer = SnapshotWriter(batch_size, use_copy=use_copy, cdc=cdc)
+        # Only store updates whose prediction changed, see PredictionCapture
+        self.capture = None
+        if cdc:
+            self.capture = PredictionCapture()
+            if write_behind == DROP_OLDEST:
+                logger.warning("Dropped snapshots leave gaps in the "
+                               "captured prediction history")
+        # With a policy (write_behind.COALESCE or DROP_OLDEST),
+        # store_snapshot() returns at once and a WriteBehind thread stores
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehind(
+                    self.writer.write, write_behind, write_queue, self.pool,
+                    write_rows,
+                    self.capture.rollback if self.capture else None)
+        # {trip_id: retrieval} of the last whole snapshot stored, to find
+        # the trips gone from the next one
+        self._stored_trips = {}
+        # One keep-alive session shared by all feeds, with enough pooled
+        # connections for every worker to hold its own
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Conditional request headers, per line
+        self._validators = {}
+        # (header timestamp, parsed result) of the last parse, per line
+        self._feed_cache = {}
+        self.feed_timestamp = {}
+        # Trip replacement periods ({route_id: end}) from the NYCT feed
+        # header, per line
+        self.feed_periods = {}
+        # Active alerts of all lines, by trip, route and stop
+        self.alerts = AlertIndex()
+        # Digest of the last payload, per line
+        self._feed_digest = {}
+        # Whether the last get_trips of a line returned a freshly parsed
+        # result (True) or the previous one again (False)
+        self.feed_changed = {}
+        # Optional FeedArchive receiving every new raw payload
+        self.archive = archive
+        # Parse feeds in this many worker processes, 0 to parse in-thread
+        self.parse_workers = parse_workers
+        self._parse_pool = None
+        if self.parse_workers:
+            # Spawned rather than forked: we are a threaded process, and
+            # the workers only need the Django-free feed_records. Created
+            # here, as every fetch thread parses; the workers only start
+            # on the first payload.
+            self._parse_pool = ProcessPoolExecutor(
+                    max_workers=self.parse_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        # Parse into lightweight TripRecord/UpdateRecord instead of models
+        self.records = records
+        # Also keep a columnar copy of every feed, see snapshot_columns()
+        self.columnar = columnar
+        self.feed_columns = {}
+        # Decode payloads straight from the wire format, see feed_wire.
+        # The columnar copy needs a FeedMessage, so it takes precedence.
+        self.wire = wire and not columnar
         self.shapes = pd.read_csv(
                 os.path.join(NYCT_Tracker.METADATA_PATH, 'shapes.txt'))
         self.stops = pd.read_csv(
                 os.path.join(NYCT_Tracker.METADATA_PATH, 'stops.txt'))
+        # Known identifiers get the smallest, most stable codes
+        SYMBOLS.seed(os.path.join(NYCT_Tracker.METADATA_PATH, 'stops.txt'),
+                     'stop_id')
+        SYMBOLS.seed(os.path.join(NYCT_Tracker.METADATA_PATH, 'routes.txt'),
+                     'route_id')
         # engine = create_engine('postgresql://%s:%s@127.0.0.1:5432/%s' % (
         #     postgres_user, postgres_password, postgres_db), echo=False)
 
+    def _wait_politely(self, line):
+        # Reserve the next slot for this feed before sleeping, so that
+        # concurrent callers for the same line queue up behind each other
+        with self._request_lock:
+            now = time.time()
+            slot = max(now, self._next_request.get(line, 0.0))
+            self._next_request[line] = slot + self.politeness
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _record_failure(self, line, response, elapsed, reason):
+        failure = Failure(
+            feed_id=self.LINE_ID[line],
+            timestamp=int(time.time()),
+            elapsed=timedelta(seconds=elapsed),
+            reason=reason[:100],
+        )
+        if response is not None:
+            failure.content = response.content
+            failure.headers = str(dict(response.headers))[:200]
+            failure.status_code = response.status_code
+        logger.warning("Fetching %s failed: %s", line, reason)
+        with self._failures_lock:
+            self.failures.append(failure)
+
     def get_trips(self, line):
-        feed = gtfs_realtime_pb2.FeedMessage()
-        response = requests.get(self.BASEURL % (
-            self.apikey, self.LINE_ID[line]))
-        feed.ParseFromString(response.content)
-        return parse_feed(feed)
+        backoff = NYCT_Tracker.BACKOFF
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(backoff)
+                backoff *= 2
+            self._wait_politely(line)
+            start = time.time()
+            response = None
+            # Only ask for a 304 when there is something to reuse
+            cached = self._feed_cache.get(line)
+            try:
+                response = self.session.get(
+                        self.baseurl % (self.apikey, self.LINE_ID[line]),
+                        headers=self._validators.get(line, {})
+                        if cached is not None else {},
+                        timeout=self.timeout)
+                self.feed_latency[line] = time.time() - start
+                if response.status_code == 304:
+                    if cached is None:
+                        raise requests.HTTPError(
+                                "304 Not Modified without a cached feed",
+                                response=response)
+                    self.feed_changed[line] = False
+                    return cached[1]
+                response.raise_for_status()
+                result = self.load_payload(line, response.content)
+            except (requests.RequestException, DecodeError) as e:
+                self._record_failure(line, response, time.time() - start,
+                                     '%s: %s' % (type(e).__name__, e))
+                if attempt == self.retries:
+                    raise
+                continue
+            validators = {}
+            if 'ETag' in response.headers:
+                validators['If-None-Match'] = response.headers['ETag']
+            if 'Last-Modified' in response.headers:
+                validators['If-Modified-Since'] = \
+                    response.headers['Last-Modified']
+            self._validators[line] = validators
+            return result
+
+    def cooldown(self, line):
+        ''' Seconds until the circuit breaker of line lets a fetch through
+        again, 0 when it does now '''
+        return self.breakers[line].remaining()
 
-    def get_all_trips(self):
+    def fetch_trips(self, line):
+        ''' Like get_trips, but returns None instead of raising, and
+        does not even try while the circuit breaker of line is open '''
+        breaker = self.breakers[line]
+        if not breaker.allow():
+            return None
+        try:
+            result = self.get_trips(line)
+        except KeyboardInterrupt:
+            raise
+        except:
+            logger.exception("Giving up on %s", line)
+            breaker.failure()
+            return None
+        breaker.success()
+        return result
+
+    def load_payload(self, line, content):
+        ''' Parse a raw GTFS-realtime payload of line, as if it had just
+        been fetched '''
+        cached = self._feed_cache.get(line)
+        self.feed_changed[line] = False
+        digest = hashlib.sha1(content).digest()
+        if cached is not None and digest == self._feed_digest.get(line):
+            # Byte for byte what we parsed last time
+            return cached[1]
+        if self.parse_workers:
+            if self.wire:
+                (timestamp, periods, alerts, trips, updates,
+                 unknown) = self._parse_pool.submit(decode_payload,
+                                                    content).result()
+            else:
+                (timestamp, periods, alerts, trips, updates, unknown,
+                 columns) = self._parse_pool.submit(parse_payload, content,
+                                                    self.columnar).result()
+        elif self.wire:
+            (timestamp, periods, alerts, trips, updates,
+             unknown) = decode_payload(content)
+        else:
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.ParseFromString(content)
+            timestamp = feed.header.timestamp
+            periods = replacement_periods(feed)
+            alerts = alert_entities(feed)
+        if cached is not None and timestamp <= cached[0]:
+            # The MTA has not republished this feed since our last parse
+            return cached[1]
+        if self.archive is not None:
+            self.archive.append(self.LINE_ID[line], timestamp, content)
+        alerts_changed = self.alerts.update(line, alerts, timestamp)
+        if self.columnar:
+            if not self.parse_workers:
+                columns = parse_columns(feed)
+            self.feed_columns[line] = columns
+        if self.parse_workers or self.wire:
+            if self.records:
+                result = trips, updates, unknown
+            else:
+                result = records_to_models(trips, updates, unknown)
+        elif self.records:
+            result = parse_records(feed)
+        else:
+            result = parse_feed(feed)
+        # The parsers only see alerts that follow the trips they name
+        self._flag_alerts(line, result[0])
+        if alerts_changed:
+            # An alert of this feed may name trips of any other
+            for other, (_, cached) in list(self._feed_cache.items()):
+                if other != line:
+                    self._flag_alerts(other, cached[0])
+        self._feed_cache[line] = (timestamp, result)
+        self._feed_digest[line] = digest
+        self.feed_timestamp[line] = timestamp
+        self.feed_periods[line] = periods
+        self.feed_changed[line] = True
+        return result
+
+    @property
+    def fetching(self):
+        ''' Lines whose fetch is still running from an earlier get_feeds '''
+        return set(self._pending)
+
+    def _flag_alerts(self, line, trips):
+        ''' Flag the trips of line, and its columns, named by an active
+        alert of any feed '''
+        for trip in trips:
+            trip.alert = self.alerts.affects(trip)
+        columns = self.feed_columns.get(line)
+        if columns is not None:
+            trip_columns = columns[0]
+            trip_columns['alert'] = np.isin(
+                    trip_columns['trip_id'], list(self.alerts.by_trip)) | \
+                np.isin(trip_columns['route_id'], list(self.alerts.by_route))
+
+    def get_feeds(self, lines=None, concurrent=None):
+        ''' Fetch and parse several lines (all of them by default),
+        returning a dict of line -> (trips, updates, other).
+        Lines that failed, or took longer than the deadline, are left out;
+        late results are included in the next call. '''
+        if lines is None:
+            lines = list(self.LINE_ID)
+        if concurrent is None:
+            concurrent = self.concurrent
+        start = time.time()
+        results = {}
+        if concurrent:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+            for line in lines:
+                if line not in self._pending:
+                    self._pending[line] = self._executor.submit(
+                            self.fetch_trips, line)
+            # Don't let a slow feed hold back the others
+            wait(list(self._pending.values()), timeout=self.deadline)
+            for line, future in list(self._pending.items()):
+                if future.done():
+                    del self._pending[line]
+                    results[line] = future.result()
+        else:
+            for line in lines:
+                results[line] = self.fetch_trips(line)
+                time.sleep(self.politeness)
+        self.cycle_latency = time.time() - start
+        logger.debug("Fetched %d feeds in %.3fs (%s)",
+                     len(results), self.cycle_latency,
+                     ', '.join('%s %.3fs' % (line, self.feed_latency[line])
+                               for line in results
+                               if line in self.feed_latency))
+        return dict((line, result) for line, result in results.items()
+                    if result is not None)
+
+    def snapshot_columns(self, lines=None):
+        ''' (trips, updates) structured arrays of the latest parse of
+        several lines (all of them by default). Needs columnar=True. '''
+        if lines is None:
+            lines = list(self.LINE_ID)
+        columns = [self.feed_columns[line] for line in lines
+                   if line in self.feed_columns]
+        if not columns:
+            return (np.zeros(0, dtype=TRIP_DTYPE),
+                    np.zeros(0, dtype=UPDATE_DTYPE))
+        return (np.concatenate([trips for trips, _ in columns]),
+                np.concatenate([updates for _, updates in columns]))
+
+    def get_all_trips(self, concurrent=None):
         alltrips = []
         allupdates = []
         otheroutput = []
+        feeds = self.get_feeds(concurrent=concurrent)
+        # Results are gathered in LINE_ID order, so the output is the
+        # same as the sequential path regardless of completion order
         for line in self.LINE_ID:
-            trips, updates, other = self.get_trips(line)
+            if line not in feeds:
+                continue
+            trips, updates, other = feeds[line]
             alltrips = alltrips + trips
             allupdates = allupdates + updates
             otheroutput = otheroutput + other
-            time.sleep(0.250)
         return alltrips, allupdates, otheroutput
 
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=False)
+            self._parse_pool = None
+        self.session.close()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.write_behind is not None:
+            self.write_behind.close()
+            self.write_behind = None
+
     def get_stops(self, trimmed=True):
         ret = self.stops
         if trimmed:
@@ -182,9 +550,55 @@ class NYCT_Tracker(object):
         ret = self.stops[self.stops.stop_id == stop].iloc[0]
         return ret
 
+    def _trips_removed(self, trips):
+        # (trip_id, retrieval) pairs of a whole snapshot
+        current = dict(trips)
+        removed = [(trip_id, retrieval) for trip_id, retrieval in
+                   self._stored_trips.items() if trip_id not in current]
+        self._stored_trips = current
+        return removed
+
+    def store_snapshot(self, trips, updates, removed=(), trips_removed=None):
+        ''' Store trips and updates in one transaction, with bulk inserts.
+        trips must include the parent trip of every update. With change
+        data capture, updates are the changed ones of a snapshot and
+        removed those gone from it. trips_removed are the trips gone from
+        it, taken to be those missing since the last call when None, as
+        trips is then a whole snapshot. Only queued for the write-behind
+        thread when there is one. '''
+        if trips_removed is None:
+            trips_removed = self._trips_removed(
+                    (trip.trip_id, trip.retrieval) for trip in trips)
+        else:
+            trips_removed = [(trip.trip_id, trip.retrieval)
+                             for trip in trips_removed]
+        closes = ()
+        if self.capture is not None:
+            with self.pool.lease():
+                updates, closes = self.capture.capture(updates, removed)
+        if self.write_behind is not None:
+            self.write_behind.submit(trips, updates, closes, trips_removed)
+            return
+        try:
+            with self.pool.lease():
+                return self.writer.write(trips, updates, closes,
+                                         trips_removed)
+        except:
+            if self.capture is not None:
+                self.capture.rollback(updates, closes)
+            raise
+
+    def store_columns(self, trips, updates):
+        ''' Same as store_snapshot, for the structured arrays of
+        snapshot_columns() '''
+        trips_removed = self._trips_removed(
+                zip(trips['trip_id'].tolist(), trips['retrieval'].tolist()))
+        with self.pool.lease():
+            return self.writer.write_columns(trips, updates, trips_removed)
+
     def store_trips(self, trips):
-        for trip in trips:
-            trips.save()
+        with self.pool.lease():
+            self.writer.write(trips, [])
         # timestamp = trips.index[0].split('_')[-1]
         # if self.last_trips_store == timestamp:
         #     raise RuntimeError("Timestamp %s already stored" % timestamp)
@@ -192,14 +606,22 @@ class NYCT_Tracker(object):
         # self.last_trips_store = timestamp
 
     def store_updates(self, updates):
-        for update in updates:
-            update.save()
+        with self.pool.lease():
+            self.writer.write([], updates)
         # timestamp = updates.index[0].split('_')[-1]
         # if self.last_updates_store == timestamp:
         #     raise RuntimeError("Timestamp %s already stored" % timestamp)
         # updates.to_sql('updates', self.engine, if_exists='append')
         # self.last_updates_store = timestamp
 
+    def store_failures(self):
+        with self._failures_lock:
+            failures = self.failures
+            self.failures = []
+        if failures:
+            with self.pool.lease():
+                Failure.objects.bulk_create(failures)
+
     def get_shapes(self):
         # TODO - this is horribly inefficient, and ugly. But maybe not used.
         if not self.shapes_clean:
@@ -247,8 +669,8 @@ if __name__ == '__main__':
         try:
             start = time.time()
             trips, updates, other = trk.get_all_trips()
-            trk.store_trips(trips)
-            trk.store_updates(updates)
+            trk.store_snapshot(trips, updates)
+            trk.store_failures()
             stop = time.time()
             print("%s: Trips %d, Updates %d, Other %d, Duration %.3f" % (
                     datetime.now().strftime("%y%m%d_%H%M%S"),
@@ -0,0 +1 @@
+default_app_config = 'nyct_scraper.apps.NyctScraperConfig'
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import threading
+try:
+    import gtfs_realtime_pb2
+except ImportError:
+    from . import gtfs_realtime_pb2
+
+logger = logging.getLogger(__name__)
+
+
+def alert_entities(feed):
+    ''' Serialized alert entities of a FeedMessage, the input of
+    AlertIndex.update '''
+    return [entity.SerializeToString() for entity in feed.entity
+            if entity.HasField("alert")]
+
+
+def _text(translated):
+    if len(translated.translation) == 0:
+        return ''
+    return translated.translation[0].text
+
+
+class Alert(object):
+    __slots__ = ('id', 'header', 'description', 'cause', 'effect',
+                 'active_period')
+
+    def __init__(self, entity):
+        alert = entity.alert
+        self.id = entity.id
+        self.header = _text(alert.header_text)
+        self.description = _text(alert.description_text)
+        self.cause = alert.cause
+        self.effect = alert.effect
+        self.active_period = [(period.start, period.end)
+                              for period in alert.active_period]
+
+    def next_change(self, now):
+        ''' When the alert next starts or stops being active, None when
+        it never does after now '''
+        times = [time for period in self.active_period for time in period
+                 if time and time > now]
+        return min(times) if times else None
+
+    def is_active(self, now):
+        if not self.active_period:
+            return True
+        return any((not start or start <= now) and (not end or now < end)
+                   for start, end in self.active_period)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'header': self.header,
+            'description': self.description,
+            'cause': self.cause,
+            'effect': self.effect,
+        }
+
+
+class AlertIndex(object):
+    ''' Active alerts of every feed, by trip_id, route_id and stop_id.
+
+    Built from all alert entities of a feed at once, so an alert applies
+    wherever it sits in the feed. A line's alerts are only parsed again
+    when their content changes between cycles. All of them are kept, and
+    the index is rebuilt once one starts or stops being active. '''
+    def __init__(self):
+        self._digests = {}
+        # line -> list of (Alert, [informed entity selectors])
+        self._alerts = {}
+        # When an alert next starts or stops being active
+        self._next_change = None
+        self.by_trip = {}
+        self.by_route = {}
+        self.by_stop = {}
+        self._lock = threading.Lock()
+
+    def update(self, line, entities, now):
+        ''' Refresh the alerts of line from its serialized alert entities.
+        Returns True when they changed. '''
+        digest = hashlib.sha1(b''.join(entities)).digest()
+        if self._digests.get(line) == digest:
+            with self._lock:
+                if self._next_change is None or now < self._next_change:
+                    return False
+                self._rebuild(now)
+            return True
+        alerts = []
+        for data in entities:
+            entity = gtfs_realtime_pb2.FeedEntity()
+            entity.ParseFromString(data)
+            selectors = [(selector.trip.trip_id, selector.route_id,
+                          selector.stop_id)
+                         for selector in entity.alert.informed_entity]
+            alerts.append((Alert(entity), selectors))
+        with self._lock:
+            self._digests[line] = digest
+            self._alerts[line] = alerts
+            self._rebuild(now)
+        logger.debug("%s: %d alerts", line, len(alerts))
+        return True
+
+    def _rebuild(self, now):
+        by_trip = {}
+        by_route = {}
+        by_stop = {}
+        changes = []
+        for alerts in self._alerts.values():
+            for alert, selectors in alerts:
+                change = alert.next_change(now)
+                if change is not None:
+                    changes.append(change)
+                if not alert.is_active(now):
+                    continue
+                for trip_id, route_id, stop_id in selectors:
+                    # A selector naming a trip is about that trip alone,
+                    # whatever route it gives as well
+                    if trip_id:
+                        by_trip.setdefault(trip_id, []).append(alert)
+                    elif route_id:
+                        by_route.setdefault(route_id, []).append(alert)
+                    if stop_id:
+                        by_stop.setdefault(stop_id, []).append(alert)
+        self.by_trip = by_trip
+        self.by_route = by_route
+        self.by_stop = by_stop
+        self._next_change = min(changes) if changes else None
+
+    def for_trip(self, trip_id):
+        return self.by_trip.get(trip_id, [])
+
+    def for_route(self, route_id):
+        return self.by_route.get(route_id, [])
+
+    def for_stop(self, stop_id):
+        ''' Alerts of a stop, or of its parent station ('101N' -> '101') '''
+        alerts = self.by_stop.get(stop_id, [])
+        if len(stop_id) > 3:
+            alerts = alerts + self.by_stop.get(stop_id[:3], [])
+        return alerts
+
+    def affects(self, trip):
+        ''' Whether any alert names trip, or the whole route it runs on '''
+        return trip.trip_id in self.by_trip or trip.route_id in self.by_route
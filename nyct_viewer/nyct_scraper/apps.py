@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class NyctScraperConfig(AppConfig):
+    name = 'nyct_scraper'
+
+    def ready(self):
+        from .sqlite_profile import configure
+        connection_created.connect(configure)
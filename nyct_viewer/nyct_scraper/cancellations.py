@@ -0,0 +1,115 @@
+import bisect
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+import pandas as pd
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Realtime trip ids look like 071791_7..S and static ones end with
+# 071791_7..S03R: origin time in 1/100 minutes, route and direction
+TRIP_KEY = re.compile(r'(\d{6})_(\w+?)\.+([NS])')
+TIMEZONE = ZoneInfo('America/New_York')
+
+
+def trip_key(trip_id):
+    ''' The part of a trip id shared by the static and realtime feeds,
+    or None when trip_id is not in the usual NYCT format '''
+    match = TRIP_KEY.search(trip_id)
+    if match is None:
+        return None
+    return '%s_%s..%s' % match.groups()
+
+
+class CancellationDetector(object):
+    ''' Finds scheduled trips missing from the realtime feeds.
+
+    The NYCT feed header lists, per route, a trip replacement period:
+    every scheduled trip of that route starting within the period is in
+    the feed, unless it was cancelled. Scheduled trips are indexed by
+    service and route, sorted by start time, so each cycle costs a
+    bisection and one set difference per route. '''
+    def __init__(self, metadata_path):
+        trips = pd.read_csv(os.path.join(metadata_path, 'trips.txt'),
+                            usecols=['route_id', 'service_id', 'trip_id'])
+        stop_times = pd.read_csv(
+                os.path.join(metadata_path, 'stop_times.txt'),
+                usecols=['trip_id', 'departure_time', 'stop_sequence'])
+        first = stop_times.loc[
+                stop_times.groupby('trip_id').stop_sequence.idxmin()]
+        hms = first.departure_time.str.split(':', expand=True).astype(int)
+        starts = pd.Series((hms[0] * 3600 + hms[1] * 60 + hms[2]).values,
+                           index=first.trip_id.values)
+        trips['start'] = trips.trip_id.map(starts)
+        trips = trips.dropna(subset=['start']).sort_values('start')
+        # (service_id, route_id) -> (sorted start seconds, trip keys)
+        self.index = {}
+        for (service, route), group in trips.groupby(['service_id',
+                                                      'route_id']):
+            self.index[(service, str(route))] = (
+                    [int(start) for start in group.start],
+                    [trip_key(trip_id) for trip_id in group.trip_id])
+        self.calendar = pd.read_csv(
+                os.path.join(metadata_path, 'calendar.txt'),
+                dtype={'start_date': str, 'end_date': str})
+        self.calendar_dates = pd.read_csv(
+                os.path.join(metadata_path, 'calendar_dates.txt'),
+                dtype={'date': str})
+        self._services = {}
+        logger.info("Indexed %d scheduled trips", len(trips))
+
+    def services(self, day):
+        ''' service_ids running on a date '''
+        if day not in self._services:
+            stamp = day.strftime('%Y%m%d')
+            cal = self.calendar
+            running = set(cal[(cal[day.strftime('%A').lower()] == 1) &
+                              (cal.start_date <= stamp) &
+                              (cal.end_date >= stamp)].service_id)
+            exceptions = self.calendar_dates[self.calendar_dates.date == stamp]
+            running |= set(exceptions[exceptions.exception_type == 1]
+                           .service_id)
+            running -= set(exceptions[exceptions.exception_type == 2]
+                           .service_id)
+            if len(self._services) > 4:
+                self._services = {}
+            self._services[day] = running
+        return self._services[day]
+
+    def scheduled(self, route, start, end):
+        ''' Keys of the trips of route scheduled to start in [start, end),
+        both epoch seconds '''
+        keys = set()
+        today = datetime.fromtimestamp(start, TIMEZONE).date()
+        # Trips after midnight may belong to yesterday's service day
+        for day in (today - timedelta(days=1), today):
+            midnight = datetime(day.year, day.month, day.day,
+                                tzinfo=TIMEZONE).timestamp()
+            for service in self.services(day):
+                entry = self.index.get((service, route))
+                if entry is None:
+                    continue
+                starts, trip_keys = entry
+                lo = bisect.bisect_left(starts, start - midnight)
+                hi = bisect.bisect_left(starts, end - midnight)
+                keys.update(trip_keys[lo:hi])
+        keys.discard(None)
+        return keys
+
+    def detect(self, now, periods, trips):
+        ''' Return {route_id: sorted trip keys} of the trips cancelled
+        according to periods ({route_id: end of replacement period}),
+        given the trips currently in the feeds '''
+        observed = {}
+        for trip in trips:
+            observed.setdefault(trip.route_id, set()).add(
+                    trip_key(trip.trip_id))
+        cancelled = {}
+        for route, end in periods.items():
+            missing = self.scheduled(route, now, end) - \
+                observed.get(route, set())
+            if missing:
+                cancelled[route] = sorted(missing)
+        return cancelled
@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    ''' Stops calls to something that keeps failing.
+
+    After THRESHOLD consecutive failures the breaker opens and allow()
+    refuses every call for COOLDOWN seconds. Then a single trial call is
+    let through: success closes the breaker again, failure re-opens it
+    for another cooldown. '''
+    THRESHOLD = 3
+    COOLDOWN = 120.0
+
+    def __init__(self, name, threshold=None, cooldown=None):
+        self.name = name
+        self.threshold = threshold or CircuitBreaker.THRESHOLD
+        self.cooldown = cooldown or CircuitBreaker.COOLDOWN
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def remaining(self):
+        ''' Seconds until allow() lets the trial call through, 0 when the
+        breaker is closed or a call may go ahead now '''
+        with self._lock:
+            if self.opened is None or self._trial:
+                return 0.0
+            return max(0.0, self.cooldown - (time.time() - self.opened))
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self._trial or time.time() - self.opened < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.opened is not None:
+                logger.info("%s recovered, closing circuit", self.name)
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened is None and
+                               self.failures >= self.threshold):
+                logger.warning("%s failed %d times in a row, "
+                               "opening circuit for %.0fs",
+                               self.name, self.failures, self.cooldown)
+                self.opened = time.time()
+            self._trial = False
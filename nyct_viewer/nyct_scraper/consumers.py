@@ -14,6 +14,8 @@ class ScraperConsumer(SyncConsumer):
         self.scraper = NYCT_scraper.NYCT_Scraper()
         self.scraper.subscribe(self.raw_update)
         self.current_trains = []
+        # TrainStatus of every train, by trip_id
+        self.trains = {}
 
     def raw_update(self, trips, updates, other):
             async_to_sync(self.channel_layer.group_send)(
@@ -23,12 +25,29 @@ class ScraperConsumer(SyncConsumer):
                         'data': [x.to_dict() for x in trips],
                     }
             )
-            trains = []
+            # Only trips that changed need to be enriched again
+            changes = self.scraper.latest_changes
+            for trip in changes.removed:
+                self.trains.pop(trip.trip_id, None)
+            changed = set(trip.trip_id for trip in changes.trips)
             for trip in trips:
-                trip.save()
+                train = self.trains.get(trip.trip_id)
+                at_station = trip.curr_stop_time == trip.timestamp
+                if trip.trip_id not in changed and (
+                        at_station == (train is not None and
+                                       train.at_station)):
+                    if train is not None:
+                        # The diff leaves out retrieval and timestamp
+                        train.retrieval = trip.retrieval
+                        train.trip_key = "%s_%d" % (trip.trip_id,
+                                                    trip.retrieval)
+                    continue
                 train = TrainStatus.from_trip(trip, self.scraper.trk)
                 if train is not None:
-                    trains.append(train)
+                    self.trains[trip.trip_id] = train
+                else:
+                    self.trains.pop(trip.trip_id, None)
+            trains = list(self.trains.values())
             self.current_trains = trains
             async_to_sync(self.channel_layer.group_send)(
                     "realtime_stream",
@@ -37,8 +56,41 @@ class ScraperConsumer(SyncConsumer):
                         'data': [x.to_dict() for x in trains],
                     }
             )
-            for update in updates:
-                update.save()
+            async_to_sync(self.channel_layer.group_send)(
+                    "realtime_stream",
+                    {
+                        'type': 'cancellations',
+                        'data': self.scraper.latest_cancelled,
+                    }
+            )
+            trk = self.scraper.trk
+            if trk.capture is not None:
+                # Change data capture keeps the history as intervals, only
+                # what changed is stored. Updates reference their trip at
+                # this retrieval, which must be stored with them even if
+                # only its updates changed.
+                stored = changes.trips
+                trip_ids = set(trip.trip_id for trip in stored)
+                parents = set(update.trip_id for update in changes.updates)
+                if not parents <= trip_ids:
+                    stored = stored + [trip for trip in trips
+                                       if trip.trip_id in parents and
+                                       trip.trip_id not in trip_ids]
+                stored_updates = changes.updates
+            else:
+                # Every trip and update of the feeds that changed, so Trip
+                # and Update hold a row per retrieval. Feeds that did not
+                # change were already stored last time.
+                stored = []
+                stored_updates = []
+                for line in self.scraper.changed_feeds:
+                    line_trips, line_updates, _ = \
+                        self.scraper.latest_feeds[line]
+                    stored += line_trips
+                    stored_updates += line_updates
+            # Only queued when write-behind is on (NYCT_WRITE_BEHIND)
+            trk.store_snapshot(stored, stored_updates,
+                               changes.updates_removed, changes.removed)
 
     def get_latest(self, event):
         data = []
@@ -68,3 +120,10 @@ class ScraperConsumer(SyncConsumer):
                     'data': [x.to_dict() for x in self.current_trains],
                 }
         )
+        async_to_sync(self.channel_layer.group_send)(
+                target,
+                {
+                    'type': 'cancellations',
+                    'data': self.scraper.latest_cancelled,
+                }
+        )
@@ -0,0 +1,139 @@
+import contextlib
+import logging
+import threading
+import time
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    ''' Leases on the database connections of the scraper's own threads.
+
+    Django only manages connections around requests. On the scraper and
+    write-behind threads every database access goes through lease()
+    instead. That keeps the thread's connection open across cycles, and
+    at most size threads hold one at a time: the others wait for a free
+    lease. A connection idle for check_interval seconds is checked before
+    use, as is one that saw an error, and is replaced when unusable or
+    older than max_age seconds (None keeps it).
+
+    Threads call warm() when they start, so that connecting is not part
+    of their first cycle. wait_time and max_wait are the seconds spent
+    waiting for a lease, connect_time the seconds spent connecting. '''
+    SIZE = 2
+    MAX_AGE = 3600
+    CHECK_INTERVAL = 30
+
+    def __init__(self, size=None, max_age=MAX_AGE, check_interval=None,
+                 using='default'):
+        self.size = size or ConnectionPool.SIZE
+        self.max_age = max_age
+        self.check_interval = check_interval
+        if self.check_interval is None:
+            self.check_interval = ConnectionPool.CHECK_INTERVAL
+        self.using = using
+        self._slots = threading.BoundedSemaphore(self.size)
+        # Per thread: lease depth, its connection, when that connected and
+        # when it was last checked
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.leases = 0
+        self.connects = 0
+        self.unusable = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.connect_time = 0.0
+
+    @property
+    def mean_wait(self):
+        ''' Seconds waited for a lease, on average '''
+        if not self.leases:
+            return 0.0
+        return self.wait_time / self.leases
+
+    @contextlib.contextmanager
+    def lease(self):
+        ''' The calling thread's connection, checked and connected. Leases
+        nest, the inner ones are free. '''
+        local = self._local
+        connection = connections[self.using]
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            try:
+                yield connection
+            finally:
+                local.depth -= 1
+            return
+        start = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - start
+        local.depth = 1
+        try:
+            self._check(connection)
+            self._connect(connection)
+            with self._lock:
+                self.leases += 1
+                self.wait_time += waited
+                self.last_wait = waited
+                self.max_wait = max(self.max_wait, waited)
+            try:
+                yield connection
+            except:
+                # Check it before it is used again
+                local.checked_at = 0
+                raise
+        finally:
+            local.depth = 0
+            self._slots.release()
+
+    def warm(self):
+        ''' Connect the calling thread ahead of its first lease '''
+        try:
+            with self.lease():
+                pass
+        except:
+            logger.exception("")
+
+    def close(self):
+        ''' Close the calling thread's connection, when it is done '''
+        connections[self.using].close()
+        self._local.raw = None
+
+    def _check(self, connection):
+        local = self._local
+        if connection.in_atomic_block:
+            return
+        if (connection.connection is None or
+                connection.connection is not getattr(local, 'raw', None)):
+            # Not connected yet, or by Django itself: taken as new
+            return
+        now = time.time()
+        if self.max_age is not None and now - local.connected_at > \
+                self.max_age:
+            logger.debug("Replacing a database connection %.0fs old",
+                         now - local.connected_at)
+            connection.close()
+        elif now - local.checked_at >= self.check_interval:
+            local.checked_at = now
+            if not connection.is_usable():
+                with self._lock:
+                    self.unusable += 1
+                logger.warning("Dropped an unusable database connection")
+                connection.close()
+
+    def _connect(self, connection):
+        local = self._local
+        start = time.perf_counter()
+        connection.ensure_connection()
+        if connection.connection is getattr(local, 'raw', None):
+            return
+        # A new connection, opened here or by Django itself
+        elapsed = time.perf_counter() - start
+        local.raw = connection.connection
+        local.connected_at = local.checked_at = time.time()
+        with self._lock:
+            self.connects += 1
+            self.connect_time += elapsed
+        logger.info("Connected to the database in %.3fs", elapsed)
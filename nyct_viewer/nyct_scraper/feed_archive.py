@@ -0,0 +1,168 @@
+import glob
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# One index entry per archived payload:
+# feed_id, header timestamp, offset in the segment, compressed length
+INDEX_ENTRY = struct.Struct('<IQQI')
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+
+def list_segments(path):
+    ''' Segment files under path, oldest first '''
+    return sorted(glob.glob(os.path.join(path, '*' + SEGMENT_SUFFIX)))
+
+
+def read_index(segment):
+    ''' Yield (feed_id, timestamp, offset, length) for every payload
+    stored in segment '''
+    index = segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+    with open(index, 'rb') as fil:
+        data = fil.read()
+    # A torn final entry (crash mid-write) is ignored
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    for entry in INDEX_ENTRY.iter_unpack(data[:usable]):
+        yield entry
+
+
+def read_payload(fil, offset, length):
+    ''' Read back one payload from an open segment file '''
+    fil.seek(offset)
+    return zlib.decompress(fil.read(length))
+
+
+class FeedArchive(threading.Thread):
+    ''' Append-only archive of raw GTFS-realtime payloads.
+
+    Payloads are compressed one by one and appended to segment files,
+    rolling over to a new segment once SEGMENT_SIZE is reached. Next to
+    every segment a sidecar index of fixed-size INDEX_ENTRY records
+    locates each payload, so any snapshot is a single seek away.
+    Compression and writes happen on this thread; append() only queues.
+
+    With max_bytes, the oldest segments are deleted whenever a new one
+    starts and the archive holds more than that. '''
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Seconds between flushes of the write buffers to disk
+    FLUSH_INTERVAL = 5.0
+    # Payloads waiting to be written before append() starts dropping them
+    QUEUE_SIZE = 256
+    COMPRESSION = 6
+
+    def __init__(self, path, segment_size=None, max_bytes=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.segment_size = segment_size or FeedArchive.SEGMENT_SIZE
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=FeedArchive.QUEUE_SIZE)
+        self.dropped = 0
+        self._segment = None
+        self._index = None
+        # Index entries of the payloads not flushed yet
+        self._entries = bytearray()
+        os.makedirs(self.path, exist_ok=True)
+        self.start()
+
+    def append(self, feed_id, timestamp, content):
+        try:
+            self.queue.put_nowait((feed_id, timestamp, content))
+        except queue.Full:
+            # Never hold up the scraper because the disk is slow
+            self.dropped += 1
+            logger.warning("Archive queue full, dropped %d payloads so far",
+                           self.dropped)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def _roll(self):
+        self._close_segment()
+        # UTC: local time would go back an hour once a year and sort
+        # segments out of order
+        name = time.strftime('%y%m%d_%H%M%S', time.gmtime())
+        base = os.path.join(self.path, name)
+        suffix = 0
+        while os.path.exists(base + SEGMENT_SUFFIX):
+            suffix += 1
+            # Padded, so segments sort in the order they were written
+            base = os.path.join(self.path, '%s_%04d' % (name, suffix))
+        if self.max_bytes is not None:
+            self._prune()
+        self._segment = open(base + SEGMENT_SUFFIX, 'ab',
+                             buffering=1024 * 1024)
+        self._index = open(base + INDEX_SUFFIX, 'ab')
+        logger.info("Archiving feeds to %s", base + SEGMENT_SUFFIX)
+
+    def _flush(self):
+        if self._segment is not None:
+            # Data before index, so the index never points past the data:
+            # its entries are only written once the data is flushed
+            self._segment.flush()
+            self._index.write(self._entries)
+            self._index.flush()
+            self._entries = bytearray()
+
+    def _prune(self):
+        ''' Delete the oldest segments until the archive fits max_bytes '''
+        segments = []
+        total = 0
+        for segment in list_segments(self.path):
+            files = [segment, segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX]
+            size = sum(os.path.getsize(fil) for fil in files
+                       if os.path.exists(fil))
+            segments.append((files, size))
+            total += size
+        for files, size in segments:
+            if total <= self.max_bytes:
+                break
+            for fil in files:
+                if os.path.exists(fil):
+                    os.remove(fil)
+            total -= size
+            logger.info("Deleted archive segment %s", files[0])
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._flush()
+            self._segment.close()
+            self._index.close()
+            self._segment = None
+            self._index = None
+
+    def _write(self, feed_id, timestamp, content):
+        if self._segment is None or self._segment.tell() >= self.segment_size:
+            self._roll()
+        data = zlib.compress(content, FeedArchive.COMPRESSION)
+        offset = self._segment.tell()
+        self._segment.write(data)
+        self._entries += INDEX_ENTRY.pack(feed_id, timestamp, offset,
+                                          len(data))
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=FeedArchive.FLUSH_INTERVAL)
+            except queue.Empty:
+                item = False
+            try:
+                if item is None:
+                    break
+                if item:
+                    self._write(*item)
+                if time.time() - last_flush >= FeedArchive.FLUSH_INTERVAL:
+                    self._flush()
+                    last_flush = time.time()
+            except:
+                logger.exception("")
+        self._close_segment()
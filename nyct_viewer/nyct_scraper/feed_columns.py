@@ -0,0 +1,135 @@
+# Column-oriented feed parsing: one typed NumPy column per Trip and per
+# Update field, filled straight from the FeedMessage. Like feed_records,
+# this module stays Django-free so that it can run in worker processes.
+import numpy as np
+try:
+    import nyct_subway_pb2
+except ImportError:
+    from . import nyct_subway_pb2
+
+# Sizes follow the max_length of the matching model fields
+TRIP_DTYPE = np.dtype([
+    ('alert', '?'),
+    ('curr_stop', 'U4'),
+    ('curr_stop_time', 'u4'),
+    ('current_status', 'i2'),
+    ('current_stop_sequence', 'i2'),
+    ('direction', 'i2'),
+    ('is_assigned', '?'),
+    ('next_stop', 'U4'),
+    ('next_stop_time', 'u4'),
+    ('route_id', 'U4'),
+    ('timestamp', 'u4'),
+    ('train_id', 'U20'),
+    ('trip_id', 'U20'),
+    ('retrieval', 'u4'),
+])
+UPDATE_DTYPE = np.dtype([
+    ('arrival', 'u4'),
+    ('departure', 'u4'),
+    ('schedule_relationship', 'i2'),
+    ('actual_track', 'U2'),
+    ('scheduled_track', 'U2'),
+    ('stop', 'U4'),
+    ('trip_id', 'U20'),
+    ('retrieval', 'u4'),
+])
+
+
+def empty_trips(size):
+    ''' Trip columns holding the same defaults as the Trip model '''
+    trips = np.zeros(size, dtype=TRIP_DTYPE)
+    trips['current_status'] = -1
+    trips['current_stop_sequence'] = -1
+    trips['direction'] = -1
+    return trips
+
+
+def parse_columns(feed):
+    ''' Same content as NYCT_tracker.parse_feed, as a pair of structured
+    arrays (trips, updates) of TRIP_DTYPE and UPDATE_DTYPE '''
+    entities = feed.entity
+    feed_query_time = feed.header.timestamp
+    # Preallocate for the worst case and trim at the end
+    trips = empty_trips(len(entities))
+    updates = np.zeros(sum(len(entity.trip_update.stop_time_update)
+                           for entity in entities
+                           if entity.HasField("trip_update")),
+                       dtype=UPDATE_DTYPE)
+    updates['retrieval'] = feed_query_time
+    # Column views, so every assignment below is a plain array store
+    t = dict((name, trips[name]) for name in TRIP_DTYPE.names)
+    u = dict((name, updates[name]) for name in UPDATE_DTYPE.names)
+    rows = {}
+    n_updates = 0
+
+    def trip_row(trip_id, route_id):
+        row = rows.get(trip_id)
+        if row is None:
+            row = rows[trip_id] = len(rows)
+            t['trip_id'][row] = trip_id
+            t['route_id'][row] = route_id
+            t['retrieval'][row] = feed_query_time
+        return row
+
+    for entity in entities:
+        if entity.HasField("vehicle"):
+            vehicle = entity.vehicle
+            row = trip_row(vehicle.trip.trip_id, vehicle.trip.route_id)
+            nyct_trip = vehicle.trip.Extensions[
+                    nyct_subway_pb2.nyct_trip_descriptor]
+            t['is_assigned'][row] = nyct_trip.is_assigned
+            t['train_id'][row] = nyct_trip.train_id
+            t['direction'][row] = nyct_trip.direction
+            t['timestamp'][row] = vehicle.timestamp
+            t['current_stop_sequence'][row] = vehicle.current_stop_sequence
+            t['current_status'][row] = vehicle.current_status
+        elif entity.HasField("trip_update"):
+            upd = entity.trip_update
+            trip_id = upd.trip.trip_id
+            row = trip_row(trip_id, upd.trip.route_id)
+            for update in upd.stop_time_update:
+                nyct_update = update.Extensions[
+                        nyct_subway_pb2.nyct_stop_time_update]
+                u['arrival'][n_updates] = update.arrival.time
+                u['departure'][n_updates] = update.departure.time
+                u['schedule_relationship'][n_updates] = \
+                    update.schedule_relationship
+                u['actual_track'][n_updates] = nyct_update.actual_track
+                u['scheduled_track'][n_updates] = nyct_update.scheduled_track
+                u['stop'][n_updates] = update.stop_id
+                u['trip_id'][n_updates] = trip_id
+                n_updates += 1
+            stop_times = upd.stop_time_update
+            t['curr_stop'][row] = stop_times[0].stop_id
+            t['curr_stop_time'][row] = stop_times[0].departure.time
+            following = stop_times[1] if len(stop_times) > 1 \
+                else stop_times[0]
+            t['next_stop'][row] = following.stop_id
+            t['next_stop_time'][row] = following.departure.time
+        elif entity.HasField("alert"):
+            for selector in entity.alert.informed_entity:
+                row = rows.get(selector.trip.trip_id)
+                if row is not None:
+                    t['alert'][row] = True
+    return trips[:len(rows)], updates[:n_updates]
+
+
+def records_to_columns(records, dtype):
+    ''' Structured array of dtype from models or feed records '''
+    names = dtype.names
+    return np.array([tuple(getattr(record, name) for name in names)
+                     for record in records], dtype=dtype)
+
+
+def to_arrow(columns):
+    ''' pyarrow Table with one column per field of a structured array '''
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("pyarrow is needed for Arrow output, "
+                          "install it or use the NumPy arrays directly")
+    names = columns.dtype.names
+    return pa.Table.from_arrays(
+            [pa.array(np.ascontiguousarray(columns[name])) for name in names],
+            names=list(names))
@@ -0,0 +1,119 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fields that place a train on the line; a change in any of them means
+# the train moved. Feed records compare the interned codes instead of the
+# strings, see _fields().
+POSITION_FIELDS = ('curr_stop', 'current_status', 'current_stop_sequence',
+                   'next_stop')
+# Everything else that is worth telling clients about. The vehicle
+# timestamp and the retrieval change with every poll and are not compared:
+# a trip that only differs in them is unchanged, and whoever keeps state
+# derived from them (at_station, trip_key) refreshes it from the snapshot.
+PREDICTION_FIELDS = ('curr_stop_time', 'next_stop_time', 'alert',
+                     'is_assigned', 'direction', 'train_id')
+UPDATE_FIELDS = ('arrival', 'departure', 'schedule_relationship',
+                 'actual_track', 'scheduled_track')
+CODES = {
+    'curr_stop': 'curr_stop_code',
+    'next_stop': 'next_stop_code',
+    'trip_id': 'trip_code',
+    'stop': 'stop_code',
+}
+
+
+def _fields(obj, names):
+    # Interned codes where the object has them, they compare faster
+    if hasattr(obj, 'trip_code'):
+        return tuple(CODES.get(name, name) for name in names)
+    return names
+
+
+def _key(obj, names):
+    return tuple(getattr(obj, name) for name in names)
+
+
+class ChangeSet(object):
+    ''' Differences between two consecutive snapshots.
+
+    Trips are classified as added, removed, moved (position changed) or
+    predicted (only predictions changed); stop time updates as added,
+    removed or changed. Anything not listed here did not change. '''
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.moved = []
+        self.predicted = []
+        self.updates_added = []
+        self.updates_removed = []
+        self.updates_changed = []
+
+    @property
+    def trips(self):
+        ''' Trips of the new snapshot that differ from the previous one '''
+        return self.added + self.moved + self.predicted
+
+    @property
+    def updates(self):
+        ''' Updates of the new snapshot that differ from the previous one '''
+        return self.updates_added + self.updates_changed
+
+    def __len__(self):
+        return (len(self.added) + len(self.removed) + len(self.moved) +
+                len(self.predicted) + len(self.updates_added) +
+                len(self.updates_removed) + len(self.updates_changed))
+
+    def __repr__(self):
+        return ('<ChangeSet trips +%d -%d moved %d predicted %d, '
+                'updates +%d -%d changed %d>' % (
+                    len(self.added), len(self.removed), len(self.moved),
+                    len(self.predicted), len(self.updates_added),
+                    len(self.updates_removed), len(self.updates_changed)))
+
+
+class SnapshotDiff(object):
+    ''' Diffs every snapshot against the one before it.
+    Trips are keyed by trip_id, updates by (trip_id, stop). '''
+    def __init__(self):
+        self._trips = {}
+        self._updates = {}
+
+    def diff(self, trips, updates):
+        changes = ChangeSet()
+        previous = self._trips
+        current = {}
+        if trips:
+            key = _fields(trips[0], ('trip_id',))
+            position = _fields(trips[0], POSITION_FIELDS)
+            prediction = _fields(trips[0], PREDICTION_FIELDS)
+        for trip in trips:
+            trip_key = _key(trip, key)
+            current[trip_key] = trip
+            old = previous.pop(trip_key, None)
+            if old is None:
+                changes.added.append(trip)
+            elif _key(old, position) != _key(trip, position):
+                changes.moved.append(trip)
+            elif _key(old, prediction) != _key(trip, prediction):
+                changes.predicted.append(trip)
+        changes.removed = list(previous.values())
+        self._trips = current
+
+        previous = self._updates
+        current = {}
+        if updates:
+            key = _fields(updates[0], ('trip_id', 'stop'))
+            fields = _fields(updates[0], UPDATE_FIELDS)
+        for update in updates:
+            update_key = _key(update, key)
+            current[update_key] = update
+            old = previous.pop(update_key, None)
+            if old is None:
+                changes.updates_added.append(update)
+            elif _key(old, fields) != _key(update, fields):
+                changes.updates_changed.append(update)
+        changes.updates_removed = list(previous.values())
+        self._updates = current
+        logger.debug("%r", changes)
+        return changes
@@ -0,0 +1,226 @@
+# Django-free feed parsing, so that it can run in worker processes.
+# TripRecord and UpdateRecord carry the same fields as the Trip and Update
+# models at a fraction of the cost, and pickle as plain tuples on their way
+# back to the scraper. They only become model instances when stored.
+# Stop, route and trip ids are held as SYMBOLS codes and only decoded when
+# read, so a record costs no string allocations for them.
+try:
+    import gtfs_realtime_pb2
+    import nyct_subway_pb2
+    from feed_columns import parse_columns
+    from symbols import SYMBOLS
+    from alerts import alert_entities
+except ImportError:
+    from . import gtfs_realtime_pb2
+    from . import nyct_subway_pb2
+    from .feed_columns import parse_columns
+    from .symbols import SYMBOLS
+    from .alerts import alert_entities
+
+TRIP_FIELDS = (
+    'alert', 'curr_stop', 'curr_stop_time', 'current_status',
+    'current_stop_sequence', 'direction', 'is_assigned', 'next_stop',
+    'next_stop_time', 'route_id', 'timestamp', 'train_id', 'trip_id',
+    'retrieval',
+)
+UPDATE_FIELDS = (
+    'arrival', 'departure', 'schedule_relationship', 'actual_track',
+    'scheduled_track', 'stop', 'trip_id', 'retrieval',
+)
+
+
+EMPTY = SYMBOLS.encode('')
+
+
+def _symbol(slot):
+    # Attribute that reads and writes the string behind a code slot
+    def get(self):
+        return SYMBOLS.strings[getattr(self, slot)]
+
+    def set(self, value):
+        setattr(self, slot, SYMBOLS.encode(value))
+    return property(get, set)
+
+
+class TripRecord(object):
+    ''' Lightweight stand-in for the Trip model '''
+    __slots__ = (
+        'trip_code', 'route_code', 'curr_stop_code', 'next_stop_code',
+        'alert', 'curr_stop_time', 'current_status', 'current_stop_sequence',
+        'direction', 'is_assigned', 'next_stop_time', 'timestamp',
+        'train_id', 'retrieval',
+    )
+    _STATE = TRIP_FIELDS
+
+    trip_id = _symbol('trip_code')
+    route_id = _symbol('route_code')
+    curr_stop = _symbol('curr_stop_code')
+    next_stop = _symbol('next_stop_code')
+
+    def __init__(self, trip_code, route_code, retrieval):
+        # Same defaults as the Trip model
+        self.trip_code = trip_code
+        self.route_code = route_code
+        self.curr_stop_code = EMPTY
+        self.next_stop_code = EMPTY
+        self.alert = False
+        self.curr_stop_time = 0
+        self.current_status = -1
+        self.current_stop_sequence = -1
+        self.direction = -1
+        self.is_assigned = False
+        self.next_stop_time = 0
+        self.timestamp = 0
+        self.train_id = ''
+        self.retrieval = retrieval
+
+    def __reduce__(self):
+        return _from_state, (TripRecord, self.values())
+
+    def values(self):
+        return tuple(getattr(self, field) for field in TRIP_FIELDS)
+
+    def to_dict(self):
+        return dict(zip(TRIP_FIELDS, self.values()))
+
+    def to_model(self):
+        from .models import Trip
+        return Trip(**self.to_dict())
+
+
+class UpdateRecord(object):
+    ''' Lightweight stand-in for the Update model '''
+    __slots__ = (
+        'trip_code', 'stop_code', 'arrival', 'departure',
+        'schedule_relationship', 'actual_track', 'scheduled_track',
+        'retrieval',
+    )
+    _STATE = UPDATE_FIELDS
+
+    trip_id = _symbol('trip_code')
+    stop = _symbol('stop_code')
+
+    def __init__(self, trip_code, stop_code, arrival, departure,
+                 schedule_relationship, actual_track, scheduled_track,
+                 retrieval):
+        self.trip_code = trip_code
+        self.stop_code = stop_code
+        self.arrival = arrival
+        self.departure = departure
+        self.schedule_relationship = schedule_relationship
+        self.actual_track = actual_track
+        self.scheduled_track = scheduled_track
+        self.retrieval = retrieval
+
+    def __reduce__(self):
+        return _from_state, (UpdateRecord, self.values())
+
+    def values(self):
+        return tuple(getattr(self, field) for field in UPDATE_FIELDS)
+
+    def to_dict(self):
+        return dict(zip(UPDATE_FIELDS, self.values()))
+
+    def to_model(self):
+        from .models import Update
+        # parent_trip is filled in when stored, see SnapshotWriter
+        return Update(**self.to_dict())
+
+
+def _from_state(cls, state):
+    # Codes are private to a process: records cross process boundaries as
+    # strings, and are encoded again in the receiving process
+    record = cls.__new__(cls)
+    for field, value in zip(cls._STATE, state):
+        setattr(record, field, value)
+    return record
+
+
+def parse_records(feed):
+    ''' Same as NYCT_tracker.parse_feed, but returns TripRecord and
+    UpdateRecord instances '''
+    encode = SYMBOLS.encode
+    unknown = []
+    trips_raw = {}
+    updates_raw = []
+    feed_query_time = feed.header.timestamp
+    for entity in feed.entity:
+        if entity.HasField("vehicle"):
+            vehicle = entity.vehicle
+            trip_code = encode(vehicle.trip.trip_id)
+            trip = trips_raw.get(trip_code)
+            if trip is None:
+                trip = TripRecord(trip_code, encode(vehicle.trip.route_id),
+                                  feed_query_time)
+                trips_raw[trip_code] = trip
+            nyct_trip = vehicle.trip.Extensions[
+                    nyct_subway_pb2.nyct_trip_descriptor]
+            trip.is_assigned = nyct_trip.is_assigned
+            trip.train_id = nyct_trip.train_id
+            trip.direction = nyct_trip.direction
+            trip.timestamp = vehicle.timestamp
+            trip.current_stop_sequence = vehicle.current_stop_sequence
+            trip.current_status = vehicle.current_status
+        elif entity.HasField("trip_update"):
+            upd = entity.trip_update
+            trip_code = encode(upd.trip.trip_id)
+            trip = trips_raw.get(trip_code)
+            if trip is None:
+                trip = TripRecord(trip_code, encode(upd.trip.route_id),
+                                  feed_query_time)
+                trips_raw[trip_code] = trip
+            start = len(updates_raw)
+            for update in upd.stop_time_update:
+                nyct_update = update.Extensions[
+                        nyct_subway_pb2.nyct_stop_time_update]
+                updates_raw.append(UpdateRecord(
+                    trip_code,
+                    encode(update.stop_id),
+                    update.arrival.time,
+                    update.departure.time,
+                    update.schedule_relationship,
+                    nyct_update.actual_track,
+                    nyct_update.scheduled_track,
+                    feed_query_time,
+                ))
+            current = updates_raw[start]
+            if len(updates_raw) > start + 1:
+                following = updates_raw[start + 1]
+            else:
+                following = current
+            trip.curr_stop_code = current.stop_code
+            trip.curr_stop_time = current.departure
+            trip.next_stop_code = following.stop_code
+            trip.next_stop_time = following.departure
+        elif entity.HasField("alert"):
+            for selector in entity.alert.informed_entity:
+                trip = trips_raw.get(encode(selector.trip.trip_id))
+                if trip is not None:
+                    trip.alert = True
+        else:
+            unknown.append(entity.SerializeToString())
+    return list(trips_raw.values()), updates_raw, unknown
+
+
+def replacement_periods(feed):
+    ''' {route_id: end of trip replacement period} from the NYCT
+    extension of the feed header '''
+    nyct_header = feed.header.Extensions[nyct_subway_pb2.nyct_feed_header]
+    return dict((period.route_id, period.replacement_period.end)
+                for period in nyct_header.trip_replacement_period)
+
+
+def parse_payload(content, columns=False):
+    ''' Process pool entry point: raw bytes in,
+    (header timestamp, replacement periods, alert entities, trips, updates,
+    unknown, columns) out. columns is (trips, updates) from
+    feed_columns.parse_columns when asked for, otherwise None '''
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    trips, updates, unknown = parse_records(feed)
+    if columns:
+        columns = parse_columns(feed)
+    else:
+        columns = None
+    return (feed.header.timestamp, replacement_periods(feed),
+            alert_entities(feed), trips, updates, unknown, columns)
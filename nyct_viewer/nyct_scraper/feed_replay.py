@@ -0,0 +1,61 @@
+import logging
+import time
+try:
+    from feed_archive import list_segments, read_index, read_payload
+except ImportError:
+    from .feed_archive import list_segments, read_index, read_payload
+
+logger = logging.getLogger(__name__)
+
+
+def iter_archive(path):
+    ''' Yield (feed_id, timestamp, payload) for every payload archived
+    under path, in the order they were archived '''
+    for segment in list_segments(path):
+        with open(segment, 'rb') as fil:
+            for feed_id, timestamp, offset, length in read_index(segment):
+                yield feed_id, timestamp, read_payload(fil, offset, length)
+
+
+class FeedReplay(object):
+    ''' Plays archived payloads back into a sink, paced by their header
+    timestamps.
+
+    speed 1.0 replays in real time, N replays N times faster, and None (or
+    0) replays as fast as the sink can take it. '''
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.snapshots = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        ''' Snapshots per second achieved by the last run '''
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.snapshots / self.elapsed
+
+    def run(self, sink, exit=None):
+        ''' Call sink(feed_id, timestamp, payload) for every archived
+        payload. Stops early once the exit Event is set. '''
+        self.snapshots = 0
+        start = time.time()
+        first = None
+        for feed_id, timestamp, payload in iter_archive(self.path):
+            if exit is not None and exit.is_set():
+                break
+            if self.speed:
+                if first is None:
+                    first = timestamp
+                delay = start + (timestamp - first) / self.speed - time.time()
+                if delay > 0:
+                    if exit is not None:
+                        exit.wait(delay)
+                    else:
+                        time.sleep(delay)
+            sink(feed_id, timestamp, payload)
+            self.snapshots += 1
+        self.elapsed = time.time() - start
+        logger.info("Replayed %d snapshots in %.3fs (%.1f/s)",
+                    self.snapshots, self.elapsed, self.rate)
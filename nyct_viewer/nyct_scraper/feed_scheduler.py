@@ -0,0 +1,146 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FeedScheduler(object):
+    ''' Decides when each feed should next be polled.
+
+    The publication period of every feed is learned from the successive
+    header timestamps it reports, and the feed is polled shortly after its
+    next expected publication. A feed whose poll failed is polled again
+    with exponential backoff.
+    All feeds share a global budget of requests per minute, to be nice
+    to the MTA however short the learned periods get. '''
+    # Initial guess at how often a feed is republished, in seconds
+    DEFAULT_PERIOD = 30.0
+    MIN_PERIOD = 5.0
+    MAX_PERIOD = 120.0
+    # How long after the expected publication to poll
+    DELAY = 2.0
+    # Random extra delay, so feeds don't drift into lock-step
+    JITTER = 1.0
+    # How soon to poll again when a feed had not been republished yet, or
+    # after its first failure
+    RETRY = 3.0
+    # Longest backoff of a feed that keeps failing
+    MAX_BACKOFF = 300.0
+    # Weight given to the newest observed period
+    SMOOTHING = 0.3
+    # Global request budget shared by all feeds
+    REQUESTS_PER_MINUTE = 60
+
+    def __init__(self, lines, budget=None):
+        self.budget = budget or FeedScheduler.REQUESTS_PER_MINUTE
+        self._lock = threading.Lock()
+        self._tokens = float(self.budget)
+        self._refilled = time.time()
+        self.period = {}
+        self.last_timestamp = {}
+        self.next_poll = {}
+        # Consecutive failed polls, per line
+        self.failures = {}
+        now = time.time()
+        for line in lines:
+            self.period[line] = FeedScheduler.DEFAULT_PERIOD
+            self.next_poll[line] = now
+
+    def _refill(self, now):
+        self._tokens = min(
+                float(self.budget),
+                self._tokens + (now - self._refilled) * self.budget / 60.0)
+        self._refilled = now
+
+    def _jitter(self):
+        return random.uniform(0.0, FeedScheduler.JITTER)
+
+    def due(self, now=None, cooldown=None):
+        ''' Return the lines that should be polled now, most overdue first.
+        Each returned line is charged against the budget, and provisionally
+        rescheduled in case its fetch never reports back. cooldown(line),
+        when given, is how many seconds a line must still wait, e.g. for
+        its circuit breaker: such a line is rescheduled then, uncharged. '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._refill(now)
+            lines = sorted((when, line)
+                           for line, when in self.next_poll.items()
+                           if when <= now)
+            ret = []
+            for _, line in lines:
+                wait = cooldown(line) if cooldown is not None else 0.0
+                if wait > 0:
+                    self.next_poll[line] = now + wait
+                    continue
+                if self._tokens < 1.0:
+                    break
+                self._tokens -= 1.0
+                self.next_poll[line] = now + FeedScheduler.RETRY
+                ret.append(line)
+            return ret
+
+    def update(self, line, timestamp, now=None):
+        ''' Record the header timestamp a poll of line returned.
+        Returns True when the feed had been republished since the last
+        poll, False otherwise. '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self.failures.pop(line, None)
+            last = self.last_timestamp.get(line)
+            if timestamp is None or (last is not None and timestamp <= last):
+                # Too early: the feed will be published any moment now
+                self.next_poll[line] = \
+                    now + FeedScheduler.RETRY + self._jitter()
+                return False
+            period = self.period[line]
+            if last is not None:
+                observed = min(max(timestamp - last, FeedScheduler.MIN_PERIOD),
+                               FeedScheduler.MAX_PERIOD)
+                period += FeedScheduler.SMOOTHING * (observed - period)
+                self.period[line] = period
+            self.last_timestamp[line] = timestamp
+            # Guard against clock skew between us and the MTA:
+            # never poll sooner than MIN_PERIOD or later than MAX_PERIOD
+            expected = timestamp + period + FeedScheduler.DELAY
+            expected = min(max(expected, now + FeedScheduler.MIN_PERIOD),
+                           now + FeedScheduler.MAX_PERIOD)
+            self.next_poll[line] = expected + self._jitter()
+            logger.debug("%s published at %d, period %.1fs, next poll in %.1fs",
+                         line, timestamp, period, self.next_poll[line] - now)
+            return True
+
+    def failed(self, line, now=None):
+        ''' Record a poll of line that returned nothing. It is polled
+        again after RETRY seconds, twice as long after every further
+        failure, up to MAX_BACKOFF. Returns that delay. '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            failures = self.failures.get(line, 0) + 1
+            self.failures[line] = failures
+            delay = min(FeedScheduler.RETRY * 2 ** (failures - 1),
+                        FeedScheduler.MAX_BACKOFF)
+            self.next_poll[line] = now + delay + self._jitter()
+            logger.debug("%s failed %d times, next poll in %.1fs",
+                         line, failures, delay)
+            return delay
+
+    def idle_seconds(self, now=None):
+        ''' Seconds until the next poll is due, or until the budget allows
+        another request, whichever is later. '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self.next_poll:
+                return FeedScheduler.MAX_PERIOD
+            self._refill(now)
+            delay = min(self.next_poll.values()) - now
+            if self._tokens < 1.0:
+                delay = max(delay,
+                            (1.0 - self._tokens) * 60.0 / self.budget)
+            return delay
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+try:
+    import gtfs_realtime_pb2
+    import nyct_subway_pb2
+    from feed_replay import iter_archive
+except ImportError:
+    from . import gtfs_realtime_pb2
+    from . import nyct_subway_pb2
+    from .feed_replay import iter_archive
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_feed(feed_id, timestamp, routes, trips=100, stops=20):
+    ''' Build a plausible NYCT GTFS-realtime payload: every trip gets a
+    vehicle position and a trip update with stops predictions '''
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = timestamp
+    nyct_header = feed.header.Extensions[nyct_subway_pb2.nyct_feed_header]
+    nyct_header.nyct_subway_version = '1.0'
+    for route in routes:
+        period = nyct_header.trip_replacement_period.add()
+        period.route_id = route
+        period.replacement_period.end = timestamp + 30 * 60
+    for i in range(trips):
+        route = routes[i % len(routes)]
+        bound = 'N' if i % 2 == 0 else 'S'
+        # Trips depart every minute; the origin time is in 1/100 minutes
+        origin = (timestamp // 60 - i) % 1440
+        trip_id = '%06d_%s..%s' % (origin * 100, route, bound)
+        update = feed.entity.add()
+        update.id = str(2 * i + 1)
+        trip = update.trip_update.trip
+        trip.trip_id = trip_id
+        trip.route_id = route
+        trip.start_date = time.strftime('%Y%m%d', time.gmtime(timestamp))
+        nyct_trip = trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
+        nyct_trip.train_id = '0%s %04d+ %03d/%03d' % (route, origin, feed_id, i)
+        nyct_trip.is_assigned = True
+        nyct_trip.direction = 1 if bound == 'N' else 3
+        for j in range(stops):
+            stop_time = update.trip_update.stop_time_update.add()
+            stop_time.stop_id = '%s%02d%s' % (route[0], j + 1, bound)
+            stop_time.arrival.time = timestamp + 90 * j
+            stop_time.departure.time = timestamp + 90 * j + 30
+            nyct_update = stop_time.Extensions[
+                    nyct_subway_pb2.nyct_stop_time_update]
+            nyct_update.scheduled_track = '1'
+            nyct_update.actual_track = '1'
+        vehicle = feed.entity.add()
+        vehicle.id = str(2 * i + 2)
+        vehicle.vehicle.trip.CopyFrom(trip)
+        vehicle.vehicle.current_stop_sequence = i % stops
+        vehicle.vehicle.current_status = i % 3
+        vehicle.vehicle.timestamp = timestamp
+    return feed.SerializeToString()
+
+
+class FeedServer(ThreadingHTTPServer):
+    ''' Stand-in for the MTA feed endpoint, for load and failure testing.
+
+    Serves /<anything>?feed_id=N from archived payloads (looping over
+    them, one per period) or from synthetic ones, optionally with extra
+    latency, a throughput cap, truncated bodies and error responses.
+    Conditional requests are answered with 304 like a real CDN would. '''
+    daemon_threads = True
+
+    def __init__(self, address, line_ids, archive=None, period=30.0,
+                 latency=0.0, bandwidth=None, truncate=0.0, error_rate=0.0,
+                 error_code=503, trips=100, stops=20):
+        ThreadingHTTPServer.__init__(self, address, FeedRequestHandler)
+        self.line_ids = line_ids
+        self.period = period
+        self.latency = latency
+        # Bytes per second per response, None for unlimited
+        self.bandwidth = bandwidth
+        # Fraction of responses cut short, and of error responses
+        self.truncate = truncate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.trips = trips
+        self.stops = stops
+        self.recorded = {}
+        if archive is not None:
+            for feed_id, timestamp, payload in iter_archive(archive):
+                self.recorded.setdefault(feed_id, []).append(payload)
+        self.started = time.time()
+        self._synthetic = {}
+        self._lock = threading.Lock()
+
+    def payload(self, feed_id):
+        ''' Current (payload, publication time) of feed_id,
+        or (None, None) for an unknown feed '''
+        step = int((time.time() - self.started) / self.period)
+        published = int(self.started + step * self.period)
+        if self.recorded:
+            payloads = self.recorded.get(feed_id)
+            if not payloads:
+                return None, None
+            return payloads[step % len(payloads)], published
+        routes = [line for line, i in self.line_ids.items() if i == feed_id]
+        if not routes:
+            return None, None
+        with self._lock:
+            if self._synthetic.get(feed_id, (None,))[0] != step:
+                self._synthetic[feed_id] = (step, synthetic_feed(
+                        feed_id, published, list(routes[0]),
+                        self.trips, self.stops))
+            return self._synthetic[feed_id][1], published
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.error_rate:
+            self._reply(server.error_code, b'')
+            return
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            payload, published = server.payload(int(query['feed_id'][0]))
+        except (KeyError, ValueError):
+            payload = None
+        if payload is None:
+            self._reply(404, b'')
+            return
+        etag = '"%s"' % hashlib.sha1(payload).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self._reply(304, b'', {'ETag': etag})
+            return
+        body = payload
+        if payload and random.random() < server.truncate:
+            body = payload[:random.randint(0, len(payload) - 1)]
+        self._reply(200, body, {
+            'ETag': etag,
+            'Last-Modified': formatdate(published, usegmt=True),
+            'Content-Type': 'application/octet-stream',
+        }, length=len(payload))
+
+    def _reply(self, code, body, headers=None, length=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        # A truncated body still announces the full length, like a
+        # connection dropped mid-transfer
+        self.send_header('Content-Length',
+                         str(length if length is not None else len(body)))
+        if length is not None and length != len(body):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = max(1, int(bandwidth / 10))
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            self.wfile.flush()
+            time.sleep(len(body[i:i + chunk]) / float(bandwidth))
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
@@ -0,0 +1,267 @@
+# Field-selective GTFS-realtime decoder working on the protobuf wire format.
+# It reads only the fields that parse_records uses and builds the same
+# TripRecord/UpdateRecord instances, without materializing FeedMessage.
+# Field numbers are those of gtfs-realtime.proto and nyct-subway.proto;
+# defaults follow proto2 rules (explicit default, else the first enum
+# value, else zero).
+from google.protobuf.message import DecodeError
+try:
+    from feed_records import TripRecord, UpdateRecord
+    from symbols import SYMBOLS
+except ImportError:
+    from .feed_records import TripRecord, UpdateRecord
+    from .symbols import SYMBOLS
+
+VARINT = 0
+FIXED64 = 1
+LENGTH = 2
+FIXED32 = 5
+NYCT_EXTENSION = 1001
+# VehiclePosition.current_status defaults to IN_TRANSIT_TO
+DEFAULT_STATUS = 2
+# NyctTripDescriptor.direction defaults to its first value, NORTH
+DEFAULT_DIRECTION = 1
+
+
+def _fields(buf, pos, end):
+    ''' Yield (field number, wire type, value) for every field of the
+    message in buf[pos:end]. value is the integer of a varint, and the
+    (start, end) of a length-delimited field; fixed fields are skipped.
+    Raises DecodeError on malformed input, like ParseFromString. '''
+    try:
+        while pos < end:
+            key = buf[pos]
+            pos += 1
+            if key & 0x80:
+                key &= 0x7f
+                shift = 7
+                while True:
+                    byte = buf[pos]
+                    pos += 1
+                    key |= (byte & 0x7f) << shift
+                    if not byte & 0x80:
+                        break
+                    shift += 7
+            wire_type = key & 7
+            if wire_type == VARINT or wire_type == LENGTH:
+                value = buf[pos]
+                pos += 1
+                if value & 0x80:
+                    value &= 0x7f
+                    shift = 7
+                    while True:
+                        byte = buf[pos]
+                        pos += 1
+                        value |= (byte & 0x7f) << shift
+                        if not byte & 0x80:
+                            break
+                        shift += 7
+                if wire_type == LENGTH:
+                    start = pos
+                    pos += value
+                    yield key >> 3, LENGTH, (start, pos)
+                else:
+                    yield key >> 3, VARINT, value
+            elif wire_type == FIXED64:
+                pos += 8
+            elif wire_type == FIXED32:
+                pos += 4
+            else:
+                raise DecodeError("Unsupported wire type %d" % wire_type)
+    except IndexError:
+        raise DecodeError("Truncated message")
+    if pos != end:
+        raise DecodeError("Field overruns its message")
+
+
+def _string(buf, span):
+    try:
+        return buf[span[0]:span[1]].decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise DecodeError("Invalid UTF-8 string: %s" % e)
+
+
+def _int64(value):
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def _time(buf, span):
+    # StopTimeEvent.time
+    time = 0
+    for field, wire_type, value in _fields(buf, span[0], span[1]):
+        if field == 2 and wire_type == VARINT:
+            time = _int64(value)
+    return time
+
+
+def _trip_descriptor(buf, span):
+    ''' (trip_id, route_id, train_id, is_assigned, direction) '''
+    trip_id = route_id = train_id = ''
+    is_assigned = False
+    direction = DEFAULT_DIRECTION
+    for field, wire_type, value in _fields(buf, span[0], span[1]):
+        if field == 1:
+            trip_id = _string(buf, value)
+        elif field == 5:
+            route_id = _string(buf, value)
+        elif field == NYCT_EXTENSION:
+            for nfield, nwire_type, nvalue in _fields(buf, value[0],
+                                                      value[1]):
+                if nfield == 1:
+                    train_id = _string(buf, nvalue)
+                elif nfield == 2:
+                    is_assigned = bool(nvalue)
+                elif nfield == 3:
+                    direction = nvalue
+    return trip_id, route_id, train_id, is_assigned, direction
+
+
+def _header(buf, span):
+    ''' (timestamp, {route_id: end of trip replacement period}) '''
+    timestamp = 0
+    periods = {}
+    for field, wire_type, value in _fields(buf, span[0], span[1]):
+        if field == 3 and wire_type == VARINT:
+            timestamp = value
+        elif field == NYCT_EXTENSION:
+            for nfield, _, nvalue in _fields(buf, value[0], value[1]):
+                if nfield != 2:
+                    continue
+                route_id = ''
+                period_end = 0
+                for pfield, _, pvalue in _fields(buf, nvalue[0], nvalue[1]):
+                    if pfield == 1:
+                        route_id = _string(buf, pvalue)
+                    elif pfield == 2:
+                        for rfield, _, rvalue in _fields(buf, pvalue[0],
+                                                         pvalue[1]):
+                            if rfield == 2:
+                                period_end = rvalue
+                periods[route_id] = period_end
+    return timestamp, periods
+
+
+def decode_payload(content):
+    ''' Decode a raw GTFS-realtime payload into
+    (header timestamp, replacement periods, alert entities, trips, updates,
+    unknown), the same as feed_records.parse_payload without columns '''
+    buf = content
+    encode = SYMBOLS.encode
+    timestamp = 0
+    periods = {}
+    entities = []
+    for field, wire_type, value in _fields(buf, 0, len(buf)):
+        if field == 1:
+            timestamp, periods = _header(buf, value)
+        elif field == 2:
+            entities.append(value)
+    alerts = []
+    unknown = []
+    trips_raw = {}
+    updates_raw = []
+    for span in entities:
+        trip_update = vehicle = alert = None
+        for field, wire_type, value in _fields(buf, span[0], span[1]):
+            if field == 3:
+                trip_update = value
+            elif field == 4:
+                vehicle = value
+            elif field == 5:
+                alert = value
+        if vehicle is not None:
+            descriptor = None
+            current_stop_sequence = 0
+            current_status = DEFAULT_STATUS
+            vehicle_timestamp = 0
+            for field, wire_type, value in _fields(buf, vehicle[0],
+                                                   vehicle[1]):
+                if field == 1:
+                    descriptor = value
+                elif field == 3:
+                    current_stop_sequence = value
+                elif field == 4:
+                    current_status = value
+                elif field == 5:
+                    vehicle_timestamp = value
+            trip_id, route_id, train_id, is_assigned, direction = \
+                _trip_descriptor(buf, descriptor or (0, 0))
+            trip_code = encode(trip_id)
+            trip = trips_raw.get(trip_code)
+            if trip is None:
+                trip = TripRecord(trip_code, encode(route_id), timestamp)
+                trips_raw[trip_code] = trip
+            trip.is_assigned = is_assigned
+            trip.train_id = train_id
+            trip.direction = direction
+            trip.timestamp = vehicle_timestamp
+            trip.current_stop_sequence = current_stop_sequence
+            trip.current_status = current_status
+        elif trip_update is not None:
+            descriptor = None
+            stop_time_updates = []
+            for field, wire_type, value in _fields(buf, trip_update[0],
+                                                   trip_update[1]):
+                if field == 1:
+                    descriptor = value
+                elif field == 2:
+                    stop_time_updates.append(value)
+            trip_id, route_id, _, _, _ = \
+                _trip_descriptor(buf, descriptor or (0, 0))
+            trip_code = encode(trip_id)
+            trip = trips_raw.get(trip_code)
+            if trip is None:
+                trip = TripRecord(trip_code, encode(route_id), timestamp)
+                trips_raw[trip_code] = trip
+            start = len(updates_raw)
+            for stu in stop_time_updates:
+                stop_id = scheduled_track = actual_track = ''
+                arrival = departure = 0
+                schedule_relationship = 0
+                for field, wire_type, value in _fields(buf, stu[0], stu[1]):
+                    if field == 4:
+                        stop_id = _string(buf, value)
+                    elif field == 2:
+                        arrival = _time(buf, value)
+                    elif field == 3:
+                        departure = _time(buf, value)
+                    elif field == 5:
+                        schedule_relationship = value
+                    elif field == NYCT_EXTENSION:
+                        for nfield, _, nvalue in _fields(buf, value[0],
+                                                         value[1]):
+                            if nfield == 1:
+                                scheduled_track = _string(buf, nvalue)
+                            elif nfield == 2:
+                                actual_track = _string(buf, nvalue)
+                updates_raw.append(UpdateRecord(
+                    trip_code, encode(stop_id), arrival, departure,
+                    schedule_relationship, actual_track, scheduled_track,
+                    timestamp))
+            # Same IndexError parse_feed raises on an empty trip update
+            current = updates_raw[start]
+            if len(updates_raw) > start + 1:
+                following = updates_raw[start + 1]
+            else:
+                following = current
+            trip.curr_stop_code = current.stop_code
+            trip.curr_stop_time = current.departure
+            trip.next_stop_code = following.stop_code
+            trip.next_stop_time = following.departure
+        elif alert is not None:
+            alerts.append(buf[span[0]:span[1]])
+            for field, wire_type, value in _fields(buf, alert[0], alert[1]):
+                if field != 5:
+                    continue
+                for sfield, _, svalue in _fields(buf, value[0], value[1]):
+                    if sfield != 4:
+                        continue
+                    trip_id, _, _, _, _ = _trip_descriptor(buf, svalue)
+                    trip = trips_raw.get(encode(trip_id))
+                    if trip is not None:
+                        trip.alert = True
+        else:
+            unknown.append(buf[span[0]:span[1]])
+    return (timestamp, periods, alerts, list(trips_raw.values()),
+            updates_raw, unknown)
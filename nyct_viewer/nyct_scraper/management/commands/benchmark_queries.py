@@ -0,0 +1,71 @@
+import time
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from nyct_scraper.models import CurrentTrip, Trip, Update
+
+
+class Command(BaseCommand):
+    help = ("Time the common lookups on the stored trips and updates, with "
+            "and (on PostgreSQL) without their indexes")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20,
+                            help="Lookups of each kind, with sampled values")
+        parser.add_argument('--window', type=int, default=1800,
+                            help="Seconds of arrivals looked up at a stop")
+        parser.add_argument('--explain', action='store_true',
+                            help="Show the query plans")
+
+    def samples(self, runs, window):
+        ''' (name, [querysets]) of every lookup, on values picked from the
+        stored rows '''
+        trips = list(Trip.objects.order_by('?').values_list(
+                'trip_id', 'route_id', 'retrieval')[:runs])
+        updates = list(Update.objects.filter(arrival__gt=0).order_by(
+                '?').values_list('stop', 'arrival')[:runs])
+        if not trips or not updates:
+            raise CommandError("Nothing stored to look up")
+        return [
+            ("latest state of a trip", [
+                Trip.objects.filter(trip_id=trip_id).order_by('-retrieval')[:1]
+                for trip_id, _, _ in trips]),
+            ("arrivals at a stop", [
+                Update.objects.filter(stop=stop, arrival__range=(
+                    arrival - window // 2, arrival + window // 2))
+                for stop, arrival in updates]),
+            ("trains of a route", [
+                Trip.objects.filter(route_id=route_id, retrieval=retrieval)
+                for _, route_id, retrieval in trips]),
+            ("trains now", [
+                CurrentTrip.objects.filter(route_id=route_id)
+                for _, route_id, _ in trips]),
+        ]
+
+    def run(self, querysets):
+        ''' Seconds per lookup, and rows per lookup '''
+        rows = 0
+        start = time.perf_counter()
+        for queryset in querysets:
+            # A fresh queryset every run, nothing is cached
+            rows += len(queryset.all())
+        elapsed = time.perf_counter() - start
+        return elapsed / len(querysets), rows / len(querysets)
+
+    def handle(self, *args, **options):
+        scans = connection.vendor == 'postgresql'
+        for name, querysets in self.samples(options['runs'],
+                                            options['window']):
+            indexed, rows = self.run(querysets)
+            line = "%-24s %8.2fms %8.1f rows" % (name, indexed * 1000, rows)
+            if scans:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    # Sequential scans only, for comparison
+                    cursor.execute("SET LOCAL enable_indexscan = off")
+                    cursor.execute("SET LOCAL enable_bitmapscan = off")
+                    cursor.execute("SET LOCAL enable_indexonlyscan = off")
+                    scanned, _ = self.run(querysets)
+                line += ", %8.2fms without indexes (%.1fx)" % (
+                    scanned * 1000, scanned / indexed)
+            self.stdout.write(line)
+            if options['explain']:
+                self.stdout.write(querysets[0].explain())
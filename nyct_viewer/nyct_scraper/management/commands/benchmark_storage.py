@@ -0,0 +1,130 @@
+import copy
+import time
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from nyct_scraper.NYCT_tracker import NYCT_Tracker
+from nyct_scraper.feed_replay import iter_archive
+from nyct_scraper.feed_server import synthetic_feed
+from nyct_scraper.snapshot_writer import SnapshotWriter
+
+
+class Command(BaseCommand):
+    help = ("Store the same replayed snapshots with every database profile "
+            "of NYCT_DATABASE_PROFILES, and compare their write rates. Every "
+            "profile gets a scratch test database, destroyed afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            default=getattr(settings, 'NYCT_ARCHIVE_DIR', None),
+                            help="Replay the payloads archived here, or "
+                                 "synthetic ones when there are none")
+        parser.add_argument('--profile', action='append',
+                            help="Profile to benchmark, repeat for several "
+                                 "(default: all of them)")
+        parser.add_argument('--limit', type=int, default=2000,
+                            help="Replay at most this many payloads, all "
+                                 "parsed up front")
+        parser.add_argument('--rounds', type=int, default=20,
+                            help="Scrape cycles of synthetic payloads")
+        parser.add_argument('--batch-size', type=int,
+                            default=getattr(settings, 'NYCT_STORE_BATCH_SIZE',
+                                            None))
+
+    def payloads(self, path, limit, rounds):
+        count = 0
+        if path:
+            for feed_id, timestamp, payload in iter_archive(path):
+                if count == limit:
+                    return
+                count += 1
+                yield feed_id, timestamp, payload
+        if count:
+            return
+        self.stdout.write("No archived payloads, using synthetic ones")
+        now = int(time.time())
+        for cycle in range(rounds):
+            # Polled every 30 seconds, like the scraper does
+            timestamp = now + 30 * cycle
+            for line, feed_id in NYCT_Tracker.LINE_ID.items():
+                if count == limit:
+                    return
+                count += 1
+                yield feed_id, timestamp, synthetic_feed(feed_id, timestamp,
+                                                         list(line))
+
+    def workload(self, path, limit, rounds):
+        ''' Every snapshot stored by a replay, as (trips, updates, trips
+        removed), and the seconds of feed time they cover '''
+        trk = NYCT_Tracker('', concurrent=False, records=True,
+                           wire=getattr(settings, 'NYCT_PARSE_WIRE', False))
+        lines = dict((v, k) for k, v in trk.LINE_ID.items())
+        snapshots = []
+        line_trips = {}
+        first = last = None
+        for feed_id, timestamp, payload in self.payloads(path, limit, rounds):
+            line = lines[feed_id]
+            trips, updates, other = trk.load_payload(line, payload)
+            if not trk.feed_changed[line]:
+                continue
+            trip_ids = set(trip.trip_id for trip in trips)
+            removed = [(trip.trip_id, trip.retrieval)
+                       for trip in line_trips.get(line, ())
+                       if trip.trip_id not in trip_ids]
+            line_trips[line] = trips
+            snapshots.append((trips, updates, removed))
+            first = timestamp if first is None else min(first, timestamp)
+            last = timestamp if last is None else max(last, timestamp)
+        trk.close()
+        if not snapshots:
+            raise CommandError("Nothing to replay")
+        return snapshots, last - first
+
+    def store(self, profile, snapshots, batch_size):
+        ''' Seconds taken by every snapshot, written with profile '''
+        alias = 'benchmark_%s' % profile
+        connections.databases[alias] = copy.deepcopy(
+                settings.NYCT_DATABASE_PROFILES[profile])
+        connections.ensure_defaults(alias)
+        connections.prepare_test_settings(alias)
+        connection = connections[alias]
+        name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        try:
+            writer = SnapshotWriter(batch_size, using=alias,
+                                    use_copy=getattr(settings,
+                                                     'NYCT_STORE_COPY', True))
+            latencies = []
+            for trips, updates, removed in snapshots:
+                start = time.perf_counter()
+                # One transaction per snapshot, as the scraper stores them
+                writer.write(trips, updates, (), removed)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+
+    def handle(self, *args, **options):
+        profiles = options['profile'] or sorted(
+                settings.NYCT_DATABASE_PROFILES)
+        for profile in profiles:
+            if profile not in settings.NYCT_DATABASE_PROFILES:
+                raise CommandError("Unknown profile %r" % profile)
+        snapshots, span = self.workload(options['path'], options['limit'],
+                                        options['rounds'])
+        rows = sum(len(trips) + len(updates)
+                   for trips, updates, _ in snapshots)
+        self.stdout.write("%d snapshots, %d rows, %ds of feeds" % (
+            len(snapshots), rows, span))
+        for profile in profiles:
+            latencies = self.store(profile, snapshots, options['batch_size'])
+            elapsed = sum(latencies)
+            latencies.sort()
+            self.stdout.write(
+                    "%-12s %8.3fs %9.0f rows/s, per snapshot %6.1fms median "
+                    "%6.1fms max, %.0fx real time" % (
+                        profile, elapsed, rows / elapsed,
+                        latencies[len(latencies) // 2] * 1000,
+                        latencies[-1] * 1000,
+                        span / elapsed))
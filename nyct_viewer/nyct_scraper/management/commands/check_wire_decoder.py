@@ -0,0 +1,93 @@
+import time
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from google.protobuf.message import DecodeError
+from nyct_scraper.NYCT_tracker import NYCT_Tracker
+from nyct_scraper.feed_records import parse_payload
+from nyct_scraper.feed_replay import iter_archive
+from nyct_scraper.feed_server import synthetic_feed
+from nyct_scraper.feed_wire import decode_payload
+
+
+class Command(BaseCommand):
+    help = ("Check that the wire-format decoder gives the same results as "
+            "the generated protobuf classes, and compare their speed")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            default=getattr(settings, 'NYCT_ARCHIVE_DIR', None),
+                            help="Check the payloads archived here, or "
+                                 "synthetic ones when there are none")
+        parser.add_argument('--limit', type=int, default=None,
+                            help="Check at most this many payloads")
+
+    def payloads(self, path, limit):
+        count = 0
+        if path:
+            for feed_id, timestamp, payload in iter_archive(path):
+                if count == limit:
+                    return
+                count += 1
+                yield feed_id, payload
+        if count:
+            return
+        self.stdout.write("No archived payloads, using synthetic ones")
+        now = int(time.time())
+        for line, feed_id in NYCT_Tracker.LINE_ID.items():
+            if count == limit:
+                return
+            count += 1
+            yield feed_id, synthetic_feed(feed_id, now, list(line))
+
+    def compare(self, expected, actual):
+        ''' Names of the parts of the decoded payload that differ '''
+        timestamp, periods, alerts, trips, updates, unknown, _ = expected
+        differences = []
+        if timestamp != actual[0]:
+            differences.append('timestamp')
+        if periods != actual[1]:
+            differences.append('replacement periods')
+        if alerts != actual[2]:
+            differences.append('alerts')
+        if [t.values() for t in trips] != [t.values() for t in actual[3]]:
+            differences.append('trips')
+        if [u.values() for u in updates] != [u.values() for u in actual[4]]:
+            differences.append('updates')
+        if unknown != actual[5]:
+            differences.append('unknown entities')
+        return differences
+
+    def handle(self, *args, **options):
+        checked = failed = 0
+        protobuf_time = wire_time = 0.0
+        for feed_id, payload in self.payloads(options['path'],
+                                              options['limit']):
+            start = time.perf_counter()
+            expected = parse_payload(payload)
+            protobuf_time += time.perf_counter() - start
+            start = time.perf_counter()
+            actual = decode_payload(payload)
+            wire_time += time.perf_counter() - start
+            checked += 1
+            differences = self.compare(expected, actual)
+            if differences:
+                failed += 1
+                self.stderr.write("Feed %d at %d: %s differ" % (
+                    feed_id, expected[0], ', '.join(differences)))
+            # Like ParseFromString, reject a payload cut short
+            try:
+                decode_payload(payload[:len(payload) * 2 // 3])
+            except DecodeError:
+                pass
+            else:
+                failed += 1
+                self.stderr.write("Feed %d at %d: truncated payload "
+                                  "decoded" % (feed_id, expected[0]))
+        if not checked:
+            raise CommandError("Nothing to check")
+        self.stdout.write("%d payloads checked, %d failed. protobuf %.3fs, "
+                          "wire %.3fs (%.1fx)" % (
+                              checked, failed, protobuf_time, wire_time,
+                              protobuf_time / wire_time))
+        if failed:
+            raise CommandError("The wire decoder does not match")
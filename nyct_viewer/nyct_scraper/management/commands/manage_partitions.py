@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from nyct_scraper import partitions
+from nyct_scraper.models import Trip, Update
+
+
+class Command(BaseCommand):
+    help = ("Create the coming daily partitions of the trip and update "
+            "tables, and remove those past the retention period. "
+            "Run it at least daily, e.g. from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-ahead', type=int,
+                            default=getattr(settings,
+                                            'NYCT_PARTITION_DAYS_AHEAD', 7),
+                            help="Days of partitions to create in advance")
+        parser.add_argument('--retention', type=int,
+                            default=getattr(settings, 'NYCT_RETENTION_DAYS',
+                                            None),
+                            help="Days of data to keep, older partitions are "
+                                 "dropped (default: keep everything)")
+        parser.add_argument('--detach', action='store_true',
+                            help="Detach expired partitions instead of "
+                                 "dropping them, to archive them yourself")
+
+    def handle(self, *args, **options):
+        today = datetime.now(timezone.utc).date()
+        before = None
+        if options['retention'] is not None:
+            before = today - timedelta(days=options['retention'])
+        if connection.vendor != 'postgresql':
+            self.prune(before)
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (Trip, Update):
+                table = model._meta.db_table
+                created = partitions.ensure_partitions(
+                        cursor, table, today,
+                        today + timedelta(days=options['days_ahead']))
+                removed = []
+                if before is not None:
+                    removed = partitions.expire_partitions(
+                            cursor, table, before, options['detach'])
+                self.stdout.write("%s: %d partitions created, %d %s" % (
+                    table, len(created), len(removed),
+                    "detached" if options['detach'] else "dropped"))
+
+    def prune(self, before):
+        ''' Without partitions, delete expired rows instead '''
+        if before is None:
+            self.stdout.write("No partitions on %s, and no retention set" %
+                              connection.vendor)
+            return
+        start = partitions.day_bounds(before)[0]
+        # Plain DELETE: the ORM would first fetch every row to null out
+        # the references to it
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (Update, Trip):
+                table = model._meta.db_table
+                cursor.execute("DELETE FROM %s WHERE retrieval < %%s" %
+                               connection.ops.quote_name(table), [start])
+                self.stdout.write("%s: %d expired rows deleted" % (
+                    table, cursor.rowcount))
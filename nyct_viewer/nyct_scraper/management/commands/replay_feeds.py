@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from nyct_scraper.NYCT_tracker import NYCT_Tracker
+from nyct_scraper.feed_replay import FeedReplay
+
+
+class Command(BaseCommand):
+    help = "Replay archived feeds through the parser and report throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            default=getattr(settings, 'NYCT_ARCHIVE_DIR', None))
+        parser.add_argument('--speed', type=float, default=0.0,
+                            help="Replay speed, 1.0 is real time and 0 "
+                                 "(default) is as fast as possible")
+        parser.add_argument('--store', action='store_true',
+                            help="Also store trips and updates in the database")
+
+    def handle(self, *args, **options):
+        trk = NYCT_Tracker(
+                '', concurrent=False,
+                records=getattr(settings, 'NYCT_PARSE_RECORDS', False),
+                wire=getattr(settings, 'NYCT_PARSE_WIRE', False),
+                batch_size=getattr(settings, 'NYCT_STORE_BATCH_SIZE', None))
+        lines = dict((v, k) for k, v in trk.LINE_ID.items())
+        counts = {'trips': 0, 'updates': 0}
+        # Trips of the last snapshot of every line, to find those removed
+        line_trips = {}
+
+        def sink(feed_id, timestamp, payload):
+            line = lines[feed_id]
+            trips, updates, other = trk.load_payload(line, payload)
+            if not trk.feed_changed[line]:
+                return
+            counts['trips'] += len(trips)
+            counts['updates'] += len(updates)
+            if options['store']:
+                # Only one line's trips, not a whole snapshot
+                trip_ids = set(trip.trip_id for trip in trips)
+                removed = [trip for trip in line_trips.get(line, ())
+                           if trip.trip_id not in trip_ids]
+                line_trips[line] = trips
+                trk.store_snapshot(trips, updates, trips_removed=removed)
+
+        replay = FeedReplay(options['path'], options['speed'] or None)
+        replay.run(sink)
+        self.stdout.write("%d snapshots (%d trips, %d updates) in %.3fs: "
+                          "%.1f snapshots/s" % (
+                              replay.snapshots, counts['trips'],
+                              counts['updates'], replay.elapsed,
+                              replay.rate))
+        if options['store']:
+            self.stdout.write("%d rows stored in %.3fs: %.0f rows/s, %d "
+                              "already stored" % (
+                                  trk.writer.rows, trk.writer.elapsed,
+                                  trk.writer.rate, trk.writer.skipped))
@@ -0,0 +1,51 @@
+from django.core.management import BaseCommand
+from nyct_scraper.NYCT_tracker import NYCT_Tracker
+from nyct_scraper.feed_server import FeedServer
+
+
+class Command(BaseCommand):
+    help = "Serve recorded or synthetic feeds in place of the MTA endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--archive', default=None,
+                            help="Serve payloads archived in this directory "
+                                 "instead of synthetic ones")
+        parser.add_argument('--period', type=float, default=30.0,
+                            help="Seconds between publications of each feed")
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Seconds to wait before every response")
+        parser.add_argument('--bandwidth', type=int, default=None,
+                            help="Cap on bytes per second of every response")
+        parser.add_argument('--truncate', type=float, default=0.0,
+                            help="Fraction of responses cut short")
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help="Fraction of requests answered with an error")
+        parser.add_argument('--error-code', type=int, default=503)
+        parser.add_argument('--trips', type=int, default=100,
+                            help="Trips per synthetic feed")
+        parser.add_argument('--stops', type=int, default=20,
+                            help="Stops per synthetic trip")
+
+    def handle(self, *args, **options):
+        server = FeedServer(
+                ('127.0.0.1', options['port']), NYCT_Tracker.LINE_ID,
+                archive=options['archive'],
+                period=options['period'],
+                latency=options['latency'],
+                bandwidth=options['bandwidth'],
+                truncate=options['truncate'],
+                error_rate=options['error_rate'],
+                error_code=options['error_code'],
+                trips=options['trips'],
+                stops=options['stops'])
+        self.stdout.write(
+                "Serving feeds, set NYCT_BASEURL to "
+                "'http://127.0.0.1:%d/mta_esi.php?key=%%s&feed_id=%%d'"
+                % options['port'])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,78 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Failure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.BinaryField()),
+                ('elapsed', models.DurationField()),
+                ('headers', models.CharField(max_length=200)),
+                ('reason', models.CharField(max_length=100)),
+                ('status_code', models.SmallIntegerField(default=-1)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('alert', models.BooleanField(default=False)),
+                ('curr_stop', models.CharField(max_length=4)),
+                ('curr_stop_time', models.PositiveIntegerField(default=0)),
+                ('current_status', models.SmallIntegerField(choices=[(-1, 'Unknown'), (0, 'Incoming_At'), (1, 'Stopped_At'), (2, 'In_Transit_To')], default=-1)),
+                ('current_stop_sequence', models.SmallIntegerField(default=-1)),
+                ('direction', models.SmallIntegerField(choices=[(-1, 'Unknown'), (1, 'North'), (3, 'South')], default=-1)),
+                ('is_assigned', models.BooleanField(default=False)),
+                ('next_stop', models.CharField(max_length=4)),
+                ('next_stop_time', models.PositiveIntegerField(default=0)),
+                ('route_id', models.CharField(max_length=4)),
+                ('timestamp', models.PositiveIntegerField(default=0)),
+                ('train_id', models.CharField(max_length=20)),
+                ('trip_id', models.CharField(max_length=20)),
+                ('retrieval', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Update',
+            fields=[
+                ('id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('arrival', models.PositiveIntegerField(default=0)),
+                ('departure', models.PositiveIntegerField(default=0)),
+                ('schedule_relationship', models.SmallIntegerField(choices=[(-1, 'Unknown'), (0, 'Scheduled'), (1, 'Added'), (2, 'Unscheduled'), (3, 'Cancelled')], default=-1)),
+                ('actual_track', models.CharField(max_length=2)),
+                ('scheduled_track', models.CharField(max_length=2)),
+                ('stop', models.CharField(max_length=4)),
+                ('trip_id', models.CharField(max_length=20)),
+                ('retrieval', models.PositiveIntegerField(default=0)),
+                ('parent_trip', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='nyct_scraper.Trip')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrainStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alert', models.BooleanField(default=False)),
+                ('nearest_stop', models.CharField(max_length=4)),
+                ('current_status', models.SmallIntegerField(choices=[(-1, 'Unknown'), (0, 'Incoming_At'), (1, 'Stopped_At'), (2, 'In_Transit_To')], default=-1)),
+                ('direction', models.SmallIntegerField(choices=[(-1, 'Unknown'), (1, 'North'), (3, 'South')], default=-1)),
+                ('at_station', models.BooleanField(default=True)),
+                ('progress', models.FloatField(default=0.0)),
+                ('timestamp', models.PositiveIntegerField(default=0)),
+                ('route_id', models.CharField(max_length=4)),
+                ('retrieval', models.PositiveIntegerField(default=0)),
+                ('lat', models.FloatField()),
+                ('lon', models.FloatField()),
+                ('stop_name', models.CharField(max_length=100)),
+                ('trip', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='nyct_scraper.Trip')),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from nyct_scraper import partitions
+
+TABLES = (
+    ('nyct_scraper_trip', ()),
+    ('nyct_scraper_update', ('parent_trip_id',)),
+)
+
+
+def partition(apps, schema_editor):
+    # Declarative partitioning is PostgreSQL only; other databases keep
+    # plain tables, pruned with DELETE by manage_partitions
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    days_ahead = getattr(settings, 'NYCT_PARTITION_DAYS_AHEAD', 7)
+    with schema_editor.connection.cursor() as cursor:
+        for table, indexes in TABLES:
+            partitions.partition_table(cursor, table, days_ahead, indexes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nyct_scraper', '0001_initial'),
+    ]
+
+    operations = [
+        # A foreign key needs a unique key on trip.id alone, which a table
+        # partitioned by retrieval cannot have
+        migrations.AlterField(
+            model_name='trainstatus',
+            name='trip',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='nyct_scraper.Trip'),
+        ),
+        migrations.AlterField(
+            model_name='update',
+            name='parent_trip',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='nyct_scraper.Trip'),
+        ),
+        migrations.RunPython(partition, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nyct_scraper', '0002_partition_by_retrieval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='update',
+            name='valid_until',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='update',
+            index=models.Index(condition=models.Q(valid_until=0), fields=['valid_until'], name='update_open_idx'),
+        ),
+    ]
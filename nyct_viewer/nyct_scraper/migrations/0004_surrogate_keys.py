@@ -0,0 +1,111 @@
+from django.db import migrations, models
+
+TRIP = 'nyct_scraper_trip'
+UPDATE = 'nyct_scraper_update'
+TRAINSTATUS = 'nyct_scraper_trainstatus'
+
+
+def postgresql_keys(connection, cursor):
+    # In place, so the tables stay partitioned (see 0002)
+    for table in (TRIP, UPDATE):
+        cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s_pkey" %
+                       (table, table))
+        cursor.execute("ALTER TABLE %s RENAME COLUMN id TO natural_key" %
+                       table)
+        cursor.execute("CREATE SEQUENCE %s_id_seq" % table)
+        cursor.execute("ALTER TABLE %s ADD COLUMN id bigint NOT NULL "
+                       "DEFAULT nextval('%s_id_seq')" % (table, table))
+        cursor.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" %
+                       (table, table))
+        cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, retrieval)" %
+                       table)
+    # An update's parent is the trip of the same trip_id and retrieval
+    cursor.execute("ALTER TABLE %s ADD COLUMN parent_trip bigint" % UPDATE)
+    cursor.execute("UPDATE %s SET parent_trip = trip.id FROM %s trip "
+                   "WHERE trip.trip_id = %s.trip_id "
+                   "AND trip.retrieval = %s.retrieval" % (
+                       UPDATE, TRIP, UPDATE, UPDATE))
+    cursor.execute("ALTER TABLE %s DROP COLUMN parent_trip_id" % UPDATE)
+    cursor.execute("ALTER TABLE %s RENAME COLUMN parent_trip TO "
+                   "parent_trip_id" % UPDATE)
+    cursor.execute("CREATE INDEX %s_parent_trip_id_idx ON %s "
+                   "(parent_trip_id)" % (UPDATE, UPDATE))
+    for table in (TRIP, UPDATE):
+        cursor.execute("ALTER TABLE %s DROP COLUMN natural_key" % table)
+    # Train statuses are never stored, there is nothing to convert. The
+    # varchar_pattern_ops index Django adds to a string foreign key cannot
+    # take a bigint, it goes first.
+    constraints = connection.introspection.get_constraints(cursor,
+                                                           TRAINSTATUS)
+    for name, constraint in constraints.items():
+        if (constraint['index'] and constraint['columns'] == ['trip_id'] and
+                name.endswith('_like')):
+            cursor.execute("DROP INDEX %s" % connection.ops.quote_name(name))
+    cursor.execute("ALTER TABLE %s ALTER COLUMN trip_id TYPE bigint "
+                   "USING NULL" % TRAINSTATUS)
+
+
+def surrogate_keys(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            postgresql_keys(connection, cursor)
+        return
+    # Elsewhere the schema editor rebuilds the tables, along with the
+    # foreign keys to Trip. The old string keys cannot become integers.
+    for name in ('Update', 'Trip'):
+        model = apps.get_model('nyct_scraper', name)
+        if model.objects.using(connection.alias).exists():
+            raise RuntimeError("Empty the %s table before migrating, only "
+                               "PostgreSQL data is converted" %
+                               model._meta.db_table)
+    for name in ('Trip', 'Update'):
+        model = apps.get_model('nyct_scraper', name)
+        old_field = model._meta.get_field('id')
+        new_field = models.BigAutoField(primary_key=True, serialize=False)
+        new_field.set_attributes_from_name('id')
+        new_field.model = model
+        schema_editor.alter_field(model, old_field, new_field)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nyct_scraper', '0003_update_valid_until'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(surrogate_keys),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='trip',
+                    name='id',
+                    field=models.BigAutoField(primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='update',
+                    name='id',
+                    field=models.BigAutoField(primary_key=True, serialize=False),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='trip',
+            constraint=models.UniqueConstraint(fields=('trip_id', 'retrieval'), name='trip_trip_retrieval_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['route_id', 'retrieval'], name='trip_route_retrieval_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='update',
+            constraint=models.UniqueConstraint(fields=('trip_id', 'stop', 'retrieval'), name='update_trip_stop_retrieval_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='update',
+            index=models.Index(fields=['stop', 'arrival'], name='update_stop_arrival_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nyct_scraper', '0004_surrogate_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentTrip',
+            fields=[
+                ('alert', models.BooleanField(default=False)),
+                ('curr_stop', models.CharField(max_length=4)),
+                ('curr_stop_time', models.PositiveIntegerField(default=0)),
+                ('current_status', models.SmallIntegerField(choices=[(-1, 'Unknown'), (0, 'Incoming_At'), (1, 'Stopped_At'), (2, 'In_Transit_To')], default=-1)),
+                ('current_stop_sequence', models.SmallIntegerField(default=-1)),
+                ('direction', models.SmallIntegerField(choices=[(-1, 'Unknown'), (1, 'North'), (3, 'South')], default=-1)),
+                ('is_assigned', models.BooleanField(default=False)),
+                ('next_stop', models.CharField(max_length=4)),
+                ('next_stop_time', models.PositiveIntegerField(default=0)),
+                ('route_id', models.CharField(max_length=4)),
+                ('timestamp', models.PositiveIntegerField(default=0)),
+                ('train_id', models.CharField(max_length=20)),
+                ('retrieval', models.PositiveIntegerField(default=0)),
+                ('trip_id', models.CharField(max_length=20, primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='currenttrip',
+            index=models.Index(fields=['route_id'], name='currenttrip_route_idx'),
+        ),
+    ]
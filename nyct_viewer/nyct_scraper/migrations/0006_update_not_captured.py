@@ -0,0 +1,29 @@
+from django.db import migrations
+
+NOT_CAPTURED = 1
+
+
+def not_captured(apps, schema_editor):
+    # Rows stored without change data capture were left open (0). Only the
+    # latest row of every stop may be; the next capture closes it, or keeps
+    # it when the prediction did not change since.
+    connection = schema_editor.connection
+    table = connection.ops.quote_name('nyct_scraper_update')
+    with connection.cursor() as cursor:
+        cursor.execute(
+                "UPDATE %s SET valid_until = %%s WHERE valid_until = 0 "
+                "AND EXISTS (SELECT 1 FROM %s later "
+                "WHERE later.trip_id = %s.trip_id AND later.stop = %s.stop "
+                "AND later.retrieval > %s.retrieval)" % (
+                    table, table, table, table, table), [NOT_CAPTURED])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nyct_scraper', '0005_currenttrip'),
+    ]
+
+    operations = [
+        migrations.RunPython(not_captured, migrations.RunPython.noop),
+    ]
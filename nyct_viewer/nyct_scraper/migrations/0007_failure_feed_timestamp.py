@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Not part of 0001, so that databases created before the migrations
+    # ("migrate --fake-initial") get them too
+    dependencies = [
+        ('nyct_scraper', '0006_update_not_captured'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='failure',
+            name='feed_id',
+            field=models.SmallIntegerField(default=-1),
+        ),
+        migrations.AddField(
+            model_name='failure',
+            name='timestamp',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,7 +1,8 @@
 from django.db import models
 
 
-class Trip(models.Model):
+class TripState(models.Model):
+    ''' Fields of a trip's state at one retrieval '''
     DIRECTION_CHOICES = (
             (-1, 'Unknown'),
             (1, 'North'),
@@ -13,7 +14,6 @@ class Trip(models.Model):
             (1, 'Stopped_At'),
             (2, 'In_Transit_To'),
     )
-    id = models.CharField(max_length=40, primary_key=True)
     alert = models.BooleanField(default=False)
     curr_stop = models.CharField(max_length=4)
     curr_stop_time = models.PositiveIntegerField(default=0)
@@ -31,9 +31,11 @@ class Trip(models.Model):
     trip_id = models.CharField(max_length=20)
     retrieval = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        abstract = True
+
     def to_dict(self):
         return {
-            'id': self.id,
             'alert': self.alert,
             'curr_stop': self.curr_stop,
             'curr_stop_time': self.curr_stop_time,
@@ -51,8 +53,43 @@ class Trip(models.Model):
         }
 
 
+class Trip(TripState):
+    ''' History: every stored state of every trip '''
+    # Rows are identified by (trip_id, retrieval); the surrogate key keeps
+    # the primary key and the foreign keys to it small
+    id = models.BigAutoField(primary_key=True)
+
+    class Meta:
+        constraints = [
+            # Also serves "latest state of a trip"
+            models.UniqueConstraint(fields=['trip_id', 'retrieval'],
+                                    name='trip_trip_retrieval_uniq'),
+        ]
+        indexes = [
+            # All trains of a route at a retrieval
+            models.Index(fields=['route_id', 'retrieval'],
+                         name='trip_route_retrieval_idx'),
+        ]
+
+
+class CurrentTrip(TripState):
+    ''' The latest state of every trip still in the feeds, one row per
+    trip, upserted along with every stored snapshot (see SnapshotWriter).
+    Reading where every train is now costs as much as there are trains,
+    whatever the length of the history. '''
+    trip_id = models.CharField(max_length=20, primary_key=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['route_id'], name='currenttrip_route_idx'),
+        ]
+
+
 class TrainStatus(models.Model):
-    trip = models.ForeignKey(Trip, on_delete=models.SET_NULL, null=True)
+    # Not enforced by the database: Trip is partitioned by retrieval, see
+    # partitions.py
+    trip = models.ForeignKey(Trip, on_delete=models.SET_NULL, null=True,
+                             db_constraint=False)
     alert = models.BooleanField(default=False)
     nearest_stop = models.CharField(max_length=4)
     current_status = models.SmallIntegerField(default=-1,
@@ -67,10 +104,13 @@ class TrainStatus(models.Model):
     lat = models.FloatField()
     lon = models.FloatField()
     stop_name = models.CharField(max_length=100)
+    # "<trip_id>_<retrieval>", what clients know the trip by: the Trip row,
+    # and so trip_id, may not be stored yet when trains are published
+    trip_key = ''
 
     def to_dict(self):
         return {
-            'trip': self.trip.id,
+            'trip': self.trip_key,
             'alert': self.alert,
             'nearest_stop': self.nearest_stop,
             'current_status': self.current_status,
@@ -103,8 +143,8 @@ class TrainStatus(models.Model):
             pass
         if stop is None:
             return None
-        return TrainStatus(
-            trip=trip,
+        # trip may also be a TripRecord, which has no primary key
+        train = TrainStatus(
             alert=trip.alert,
             nearest_stop=trip.curr_stop,
             current_status=trip.current_status,
@@ -117,6 +157,8 @@ class TrainStatus(models.Model):
             lon=stop.stop_lon,
             stop_name=stop.stop_name,
         )
+        train.trip_key = "%s_%d" % (trip.trip_id, trip.retrieval)
+        return train
 
 
 class Update(models.Model):
@@ -127,7 +169,7 @@ class Update(models.Model):
         (2, 'Unscheduled'),
         (3, 'Cancelled')
     )
-    id = models.CharField(max_length=40, primary_key=True)
+    id = models.BigAutoField(primary_key=True)
     arrival = models.PositiveIntegerField(default=0)
     departure = models.PositiveIntegerField(default=0)
     schedule_relationship = models.SmallIntegerField(default=-1,
@@ -136,12 +178,30 @@ class Update(models.Model):
     scheduled_track = models.CharField(max_length=2)
     stop = models.CharField(max_length=4)
     trip_id = models.CharField(max_length=20)
-    parent_trip = models.ForeignKey(Trip, on_delete=models.SET_NULL, null=True)
+    parent_trip = models.ForeignKey(Trip, on_delete=models.SET_NULL, null=True,
+                                    db_constraint=False)
     retrieval = models.PositiveIntegerField(default=0)
+    # With change data capture (NYCT_STORE_CDC) a row holds from retrieval
+    # until valid_until, 0 while it is the latest prediction. Rows stored
+    # without it hold NOT_CAPTURED, they are no interval.
+    valid_until = models.PositiveIntegerField(default=0)
+    NOT_CAPTURED = 1
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['trip_id', 'stop', 'retrieval'],
+                                    name='update_trip_stop_retrieval_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['valid_until'], name='update_open_idx',
+                         condition=models.Q(valid_until=0)),
+            # Arrivals at a stop in a time range
+            models.Index(fields=['stop', 'arrival'],
+                         name='update_stop_arrival_idx'),
+        ]
 
     def to_dict(self):
         return {
-            'id': self.id,
             'arrival': self.arrival,
             'departure': self.departure,
             'schedule_relationship': self.schedule_relationship,
@@ -159,3 +219,5 @@ class Failure(models.Model):
     headers = models.CharField(max_length=200)
     reason = models.CharField(max_length=100)
     status_code = models.SmallIntegerField(default=-1)
+    feed_id = models.SmallIntegerField(default=-1)
+    timestamp = models.PositiveIntegerField(default=0)
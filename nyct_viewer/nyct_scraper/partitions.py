@@ -0,0 +1,142 @@
+# Daily range partitions of the Trip and Update tables on PostgreSQL.
+# Every table is partitioned by retrieval (feed timestamp, epoch seconds)
+# into one partition per UTC day, named <table>_pYYYYMMDD, plus a default
+# partition catching rows no daily partition was created for in time.
+# Expired days are dropped (or detached) whole instead of deleted row by
+# row. Used by the migrations and by the manage_partitions command.
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+PARTITION_NAME = re.compile(r'_p(\d{8})$')
+
+
+def day_of(timestamp):
+    ''' UTC date of an epoch timestamp '''
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+
+def day_bounds(day):
+    ''' [start, end) epoch seconds of a UTC date '''
+    start = int(datetime(day.year, day.month, day.day,
+                         tzinfo=timezone.utc).timestamp())
+    return start, start + DAY
+
+
+def partition_name(table, day):
+    return '%s_p%s' % (table, day.strftime('%Y%m%d'))
+
+
+def default_name(table):
+    return '%s_default' % table
+
+
+def partitions(cursor, table):
+    ''' {date: partition name} of the daily partitions of table '''
+    cursor.execute("SELECT child.relname FROM pg_inherits "
+                   "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                   "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                   "WHERE parent.relname = %s", [table])
+    days = {}
+    for name, in cursor.fetchall():
+        match = PARTITION_NAME.search(name)
+        if match is not None:
+            day = datetime.strptime(match.group(1), '%Y%m%d').date()
+            days[day] = name
+    return days
+
+
+def create_partition(cursor, table, day):
+    ''' Create the partition of table for day, moving in any of its rows
+    that landed in the default partition meanwhile '''
+    start, end = day_bounds(day)
+    name = partition_name(table, day)
+    default = default_name(table)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM %s WHERE retrieval >= %%s "
+                   "AND retrieval < %%s)" % default, [start, end])
+    stray = cursor.fetchone()[0]
+    if stray:
+        # The new partition may not overlap rows of the default one
+        cursor.execute("CREATE TEMPORARY TABLE partition_stray (LIKE %s)" %
+                       default)
+        cursor.execute("WITH moved AS (DELETE FROM %s WHERE retrieval >= %%s "
+                       "AND retrieval < %%s RETURNING *) "
+                       "INSERT INTO partition_stray SELECT * FROM moved" %
+                       default, [start, end])
+    cursor.execute("CREATE TABLE %s PARTITION OF %s "
+                   "FOR VALUES FROM (%d) TO (%d)" % (name, table, start, end))
+    if stray:
+        cursor.execute("INSERT INTO %s SELECT * FROM partition_stray" %
+                       table)
+        cursor.execute("DROP TABLE partition_stray")
+    logger.info("Created partition %s", name)
+    return name
+
+
+def ensure_partitions(cursor, table, first, last):
+    ''' Create the missing daily partitions of table from first to last
+    (dates, inclusive). Returns the names of those created. '''
+    existing = partitions(cursor, table)
+    created = []
+    day = first
+    while day <= last:
+        if day not in existing:
+            created.append(create_partition(cursor, table, day))
+        day += timedelta(days=1)
+    return created
+
+
+def expire_partitions(cursor, table, before, detach=False):
+    ''' Drop (or only detach) the daily partitions of table for days
+    before the date before, and delete the default partition's rows
+    that old. Returns the names of the partitions removed. '''
+    removed = []
+    for day, name in sorted(partitions(cursor, table).items()):
+        if day >= before:
+            continue
+        if detach:
+            cursor.execute("ALTER TABLE %s DETACH PARTITION %s" %
+                           (table, name))
+        else:
+            cursor.execute("DROP TABLE %s" % name)
+        removed.append(name)
+        logger.info("%s partition %s", "Detached" if detach else "Dropped",
+                    name)
+    cursor.execute("DELETE FROM %s WHERE retrieval < %%s" %
+                   default_name(table), [day_bounds(before)[0]])
+    return removed
+
+
+def partition_table(cursor, table, days_ahead, indexes=()):
+    ''' Turn a plain table into one partitioned by retrieval day, with
+    partitions for every day of its data and days_ahead more. The primary
+    key becomes (id, retrieval), since it has to include the partition key;
+    indexes lists further columns to index. '''
+    new = '%s_partitioned' % table
+    cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS "
+                   "INCLUDING CONSTRAINTS) PARTITION BY RANGE (retrieval)" %
+                   (new, table))
+    cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" %
+                   (default_name(table), new))
+    cursor.execute("SELECT min(retrieval) FROM %s WHERE retrieval > 0" %
+                   table)
+    first = cursor.fetchone()[0]
+    today = datetime.now(timezone.utc).date()
+    first = min(day_of(first), today) if first else today
+    day = first
+    while day <= today + timedelta(days=days_ahead):
+        start, end = day_bounds(day)
+        cursor.execute("CREATE TABLE %s PARTITION OF %s "
+                       "FOR VALUES FROM (%d) TO (%d)" % (
+                           partition_name(table, day), new, start, end))
+        day += timedelta(days=1)
+    cursor.execute("INSERT INTO %s SELECT * FROM %s" % (new, table))
+    cursor.execute("DROP TABLE %s" % table)
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (new, table))
+    cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, retrieval)" % table)
+    for column in indexes:
+        cursor.execute("CREATE INDEX %s_%s_idx ON %s (%s)" % (
+            table, column, table, column))
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from .models import Update
+
+logger = logging.getLogger(__name__)
+
+# A new Update row is only written when one of these changes
+FIELDS = ('arrival', 'departure', 'actual_track', 'schedule_relationship')
+
+
+class PredictionCapture(object):
+    ''' Change data capture of stop time predictions.
+
+    Remembers the last stored prediction of every (trip_id, stop) and lets
+    through only updates that differ from it. Every stored row is valid
+    from its retrieval until its valid_until, 0 while it is still the
+    latest prediction; capture() returns the rows it supersedes, to be
+    closed in the same transaction (see SnapshotWriter.write). The
+    prediction for a stop at time T is the row with retrieval <= T and
+    valid_until either 0 or > T.
+
+    The open rows of a previous run are loaded on first use, so history
+    continues across restarts. Only rows stored with capture on are open,
+    the others are NOT_CAPTURED.
+
+    What capture() returns must be stored, or handed back to rollback():
+    the state is taken back to the rows in the database, and closes that
+    were lost are returned again by the next capture(). '''
+    def __init__(self, using='default'):
+        self.using = using
+        # (trip_id, stop) -> (FIELDS values, retrieval of the stored row),
+        # values None when they are not known
+        self._open = None
+        # Closes of a snapshot that was not stored, to be written again
+        self._reclose = []
+        # capture() runs on the scraper thread, rollback() on the one that
+        # failed to store
+        self._lock = threading.Lock()
+        self.captured = 0
+        self.skipped = 0
+
+    def _load(self):
+        ''' Returns the closes of open rows superseded by a later open row
+        of their stop, which only an interrupted run leaves behind '''
+        self._open = {}
+        closes = []
+        rows = Update.objects.using(self.using).filter(
+                valid_until=0).order_by('retrieval').values_list(
+                'trip_id', 'stop', *(FIELDS + ('retrieval',)))
+        for row in rows.iterator():
+            key = row[:2]
+            last = self._open.get(key)
+            if last is not None:
+                closes.append(key + (last[1], row[-1]))
+            self._open[key] = (row[2:-1], row[-1])
+        logger.info("Loaded %d open predictions, closing %d superseded",
+                    len(self._open), len(closes))
+        return closes
+
+    def capture(self, updates, removed=()):
+        ''' Returns (updates to store, closes) for a snapshot's changed
+        updates, and those no longer in the feed. closes is a list of
+        (trip_id, stop, retrieval, valid_until) of stored rows '''
+        with self._lock:
+            return self._capture(updates, removed)
+
+    def _capture(self, updates, removed):
+        first = self._open is None
+        closes = self._reclose
+        self._reclose = []
+        if first:
+            closes.extend(self._load())
+        changed = []
+        now = max([update.retrieval for update in updates] or
+                  [int(time.time())])
+        seen = set()
+        for update in updates:
+            key = (update.trip_id, update.stop)
+            values = tuple(getattr(update, field) for field in FIELDS)
+            seen.add(key)
+            last = self._open.get(key)
+            if last is not None:
+                if last[0] == values:
+                    continue
+                closes.append(key + (last[1], update.retrieval))
+            self._open[key] = (values, update.retrieval)
+            changed.append(update)
+        if first:
+            # The first snapshot lists every update in the feeds, anything
+            # else left open by a previous run has expired since
+            removed = [key for key in self._open if key not in seen]
+        else:
+            removed = [(update.trip_id, update.stop) for update in removed]
+        for key in removed:
+            last = self._open.pop(key, None)
+            if last is not None:
+                closes.append(key + (last[1], now))
+        self.captured += len(changed)
+        self.skipped += len(updates) - len(changed)
+        return changed, closes
+
+    def rollback(self, updates, closes):
+        ''' Forget what capture() returned when it was not stored '''
+        with self._lock:
+            if self._open is None:
+                self._reclose.extend(closes)
+                return
+            # Updates still taken to be the open row of their stop
+            lost = {}
+            for update in updates:
+                key = (update.trip_id, update.stop)
+                last = self._open.get(key)
+                if last is not None and last[1] == update.retrieval:
+                    lost[key] = update.retrieval
+            for close in closes:
+                key = close[:2]
+                if lost.get(key) == close[3]:
+                    # The row it superseded is still the open one
+                    self._open[key] = (None, close[2])
+                    del lost[key]
+                else:
+                    self._reclose.append(close)
+            for key in lost:
+                del self._open[key]
+        logger.warning("Rolled back %d captured updates and %d closes",
+                       len(updates), len(closes))
@@ -0,0 +1,322 @@
+import csv
+import io
+import logging
+import operator
+import time
+from functools import reduce
+from django.db import connections, transaction
+from django.db.models import Q
+from .models import CurrentTrip, Trip, Update
+from .feed_columns import TRIP_DTYPE, UPDATE_DTYPE, records_to_columns
+
+logger = logging.getLogger(__name__)
+
+
+# The unique keys of Trip and Update
+TRIP_FIELDS = ('trip_id', 'retrieval')
+UPDATE_FIELDS = ('trip_id', 'stop', 'retrieval')
+TRIP_KEY = operator.attrgetter(*TRIP_FIELDS)
+UPDATE_KEY = operator.attrgetter(*UPDATE_FIELDS)
+
+
+def _models(objs, key):
+    # Last one wins for duplicate keys, as it would with save()
+    models = {}
+    for obj in objs:
+        model = obj.to_model() if hasattr(obj, 'to_model') else obj
+        models[key(model)] = model
+    return list(models.values())
+
+
+def _columns_to_models(model, columns):
+    names = columns.dtype.names
+    return [model(**dict(zip(names, row))) for row in columns.tolist()]
+
+
+class SnapshotWriter(object):
+    ''' Writes a snapshot of trips and updates in a single transaction.
+
+    On PostgreSQL the rows are streamed with COPY through an in-memory CSV
+    buffer into a temporary staging table, then moved into place with one
+    INSERT ... SELECT. Other backends get bulk INSERTs of BATCH_SIZE rows.
+
+    Statements hold at most BATCH_SIZE rows, fewer where the database
+    limits the parameters of a query (999 on SQLite).
+
+    Rows are keyed by trip and feed timestamp, so a key that is already
+    stored holds the same data and is skipped. CurrentTrip is kept up to
+    date in the same transaction, with one upsert of the trips written and
+    one delete of those gone. Keeps track of the rows written, those
+    skipped as already stored and the time taken, see rate.
+
+    With cdc, write() takes updates from PredictionCapture and stores them
+    open (valid_until 0); otherwise updates are stored NOT_CAPTURED. '''
+    BATCH_SIZE = 1000
+
+    def __init__(self, batch_size=None, using='default', use_copy=True,
+                 cdc=False):
+        self.batch_size = batch_size or SnapshotWriter.BATCH_SIZE
+        self.using = using
+        self.use_copy = use_copy
+        self.cdc = cdc
+        self.rows = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+        self.last_rows = 0
+        self.last_skipped = 0
+        self.last_elapsed = 0.0
+        # Routes written so far: the first snapshot of a route replaces
+        # whatever CurrentTrip holds for it
+        self._routes = set()
+
+    @property
+    def rate(self):
+        ''' Rows per second over every write so far '''
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    @property
+    def copies(self):
+        ''' Whether writes go through COPY '''
+        return (self.use_copy and
+                connections[self.using].vendor == 'postgresql')
+
+    def write(self, trips, updates, closes=(), removed=()):
+        ''' Store trips (models or feed records) and updates. trips must
+        include the parent trip of every update. closes lists the
+        (trip_id, stop, retrieval, valid_until) of stored updates to close,
+        see PredictionCapture; removed the (trip_id, retrieval) of trips
+        gone from the feeds since they were last seen. '''
+        start = time.time()
+        trip_routes = [(trip.trip_id, trip.route_id) for trip in trips]
+        valid_until = 0 if self.cdc else Update.NOT_CAPTURED
+        if self.copies:
+            trips = records_to_columns(trips, TRIP_DTYPE)
+            updates = records_to_columns(updates, UPDATE_DTYPE)
+            written = self._write(self._copy, trips, updates, closes,
+                                  removed, trip_routes, valid_until)
+        else:
+            trips = _models(trips, TRIP_KEY)
+            updates = _models(updates, UPDATE_KEY)
+            written = self._write(self._insert, trips, updates, closes,
+                                  removed, trip_routes, valid_until)
+        return self._account(start, len(trips) + len(updates), *written)
+
+    def write_columns(self, trips, updates, removed=()):
+        ''' Store trips and updates given as TRIP_DTYPE and UPDATE_DTYPE
+        structured arrays, see NYCT_Tracker.snapshot_columns() '''
+        start = time.time()
+        trip_routes = list(zip(trips['trip_id'].tolist(),
+                               trips['route_id'].tolist()))
+        # Never through PredictionCapture
+        if self.copies:
+            written = self._write(self._copy, trips, updates, (), removed,
+                                  trip_routes, Update.NOT_CAPTURED)
+        else:
+            written = self._write(self._insert,
+                                  _columns_to_models(Trip, trips),
+                                  _columns_to_models(Update, updates), (),
+                                  removed, trip_routes, Update.NOT_CAPTURED)
+        return self._account(start, len(trips) + len(updates), *written)
+
+    def _write(self, method, trips, updates, closes, removed, trip_routes,
+               valid_until):
+        ''' Returns the trips and updates inserted, without those already
+        stored '''
+        routes = set(route_id for _, route_id in trip_routes) - self._routes
+        with transaction.atomic(using=self.using):
+            trips = method(Trip, trips)
+            updates = method(Update, updates, valid_until)
+            if closes:
+                self._close(closes)
+            self._remove_current(removed, trip_routes, routes)
+        # Replaced once committed
+        self._routes |= routes
+        return trips, updates
+
+    def _upsert_current(self, cursor, names, rows, params=()):
+        ''' Upsert CurrentTrip from rows, a VALUES list or a SELECT of the
+        columns names with at most one row per trip. A row never replaces
+        a later state of its trip. '''
+        quote = connections[self.using].ops.quote_name
+        table = quote(CurrentTrip._meta.db_table)
+        cursor.execute(
+                "INSERT INTO %s (%s) %s ON CONFLICT (trip_id) DO UPDATE "
+                "SET %s WHERE excluded.retrieval >= %s.retrieval" % (
+                    table, ', '.join(quote(name) for name in names), rows,
+                    ', '.join('%s = excluded.%s' % (quote(name), quote(name))
+                              for name in names if name != 'trip_id'),
+                    table), params)
+
+    def _remove_current(self, removed, trip_routes, routes):
+        objects = CurrentTrip.objects.using(self.using)
+        if routes:
+            # The first snapshot of a route lists all of its trips in the
+            # feeds, any other left by a previous run has expired since.
+            # Snapshots may only hold some of the lines, the trips of the
+            # other routes are left alone.
+            trip_ids = set(trip_id for trip_id, _ in trip_routes)
+            stale = [trip_id for trip_id in
+                     objects.filter(route_id__in=sorted(routes)).values_list(
+                         'trip_id', flat=True)
+                     if trip_id not in trip_ids]
+            batch_size = self._batch_size(('trip_id',), stale)
+            for i in range(0, len(stale), batch_size):
+                objects.filter(trip_id__in=stale[i:i + batch_size]).delete()
+        # Only states up to the one last seen, a trip that came back since
+        # (in a later snapshot of the same batch) stays
+        rows = [Q(trip_id=trip_id, retrieval__lte=retrieval)
+                for trip_id, retrieval in removed]
+        batch_size = self._batch_size(('trip_id', 'retrieval'), rows)
+        for i in range(0, len(rows), batch_size):
+            objects.filter(reduce(operator.or_,
+                                  rows[i:i + batch_size])).delete()
+
+    def _close(self, closes):
+        by_time = {}
+        for trip_id, stop, retrieval, valid_until in closes:
+            by_time.setdefault(valid_until, []).append(
+                    Q(trip_id=trip_id, stop=stop, retrieval=retrieval))
+        objects = Update.objects.using(self.using)
+        for valid_until, rows in by_time.items():
+            batch_size = self._batch_size(('trip_id', 'stop', 'retrieval'),
+                                          rows)
+            for i in range(0, len(rows), batch_size):
+                objects.filter(reduce(operator.or_,
+                                      rows[i:i + batch_size])
+                               ).update(valid_until=valid_until)
+
+    def _parents(self, updates):
+        ''' Point updates to their stored parent trip '''
+        keys = set((update.trip_id, update.retrieval) for update in updates)
+        trip_ids = sorted(set(trip_id for trip_id, _ in keys))
+        retrievals = set(retrieval for _, retrieval in keys)
+        parents = {}
+        batch_size = self._batch_size(('trip_id',), trip_ids)
+        for i in range(0, len(trip_ids), batch_size):
+            parents.update(
+                    ((trip_id, retrieval), pk) for trip_id, retrieval, pk in
+                    Trip.objects.using(self.using).filter(
+                        trip_id__in=trip_ids[i:i + batch_size],
+                        retrieval__in=retrievals).values_list(
+                        'trip_id', 'retrieval', 'pk'))
+        for update in updates:
+            update.parent_trip_id = parents.get(
+                    (update.trip_id, update.retrieval))
+
+    def _batch_size(self, fields, rows):
+        ''' Rows of fields per statement '''
+        ops = connections[self.using].ops
+        return max(1, min(self.batch_size, ops.bulk_batch_size(fields, rows)))
+
+    def _stored(self, model, objs):
+        ''' How many of objs are stored already, and will be skipped '''
+        fields = UPDATE_FIELDS if model is Update else TRIP_FIELDS
+        keys = set(map(UPDATE_KEY if model is Update else TRIP_KEY, objs))
+        trip_ids = sorted(set(obj.trip_id for obj in objs))
+        retrievals = set(obj.retrieval for obj in objs)
+        stored = 0
+        batch_size = self._batch_size(('trip_id',), trip_ids)
+        for i in range(0, len(trip_ids), batch_size):
+            stored += sum(1 for key in
+                          model.objects.using(self.using).filter(
+                              trip_id__in=trip_ids[i:i + batch_size],
+                              retrieval__in=retrievals).values_list(*fields)
+                          if key in keys)
+        return stored
+
+    def _account(self, start, given, trips, updates):
+        elapsed = time.time() - start
+        rows = trips + updates
+        skipped = given - rows
+        self.rows += rows
+        self.skipped += skipped
+        self.elapsed += elapsed
+        self.last_rows = rows
+        self.last_skipped = skipped
+        self.last_elapsed = elapsed
+        logger.info("Stored %d trips, %d updates in %.3fs: %.0f rows/s, %d "
+                    "already stored", trips, updates, elapsed,
+                    rows / elapsed if elapsed else 0.0, skipped)
+        return rows
+
+    def _insert(self, model, objs, valid_until=0):
+        if not objs:
+            return 0
+        if model is Update:
+            self._parents(objs)
+            for obj in objs:
+                obj.valid_until = valid_until
+        # bulk_create does not tell which rows the conflicts skipped
+        inserted = len(objs) - self._stored(model, objs)
+        model.objects.using(self.using).bulk_create(
+                objs, batch_size=self.batch_size, ignore_conflicts=True)
+        if model is Trip:
+            self._insert_current(objs)
+        return inserted
+
+    def _insert_current(self, trips):
+        # The latest state of every trip, a batch may hold several
+        latest = dict((trip.trip_id, trip) for trip in
+                      sorted(trips, key=operator.attrgetter('retrieval')))
+        trips = list(latest.values())
+        if not trips:
+            return
+        connection = connections[self.using]
+        names = [field.attname for field in CurrentTrip._meta.concrete_fields]
+        batch_size = self._batch_size(names, trips)
+        row = '(%s)' % ', '.join(['%s'] * len(names))
+        with connection.cursor() as cursor:
+            for i in range(0, len(trips), batch_size):
+                batch = trips[i:i + batch_size]
+                self._upsert_current(
+                        cursor, names,
+                        'VALUES %s' % ', '.join([row] * len(batch)),
+                        [getattr(trip, name) for trip in batch
+                         for name in names])
+
+    def _copy(self, model, columns, valid_until=0):
+        if len(columns) == 0:
+            return 0
+        buf = io.StringIO()
+        csv.writer(buf).writerows(columns.tolist())
+        buf.seek(0)
+        connection = connections[self.using]
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        staging = quote('copy_%s' % model._meta.db_table)
+        names = [quote(name) for name in columns.dtype.names]
+        fields = ', '.join(names)
+        with connection.cursor() as cursor:
+            # Session-private, emptied at the end of every transaction
+            cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS %s "
+                           "ON COMMIT DELETE ROWS AS SELECT %s FROM %s "
+                           "WITH NO DATA" % (staging, fields, table))
+            # Empty strings must not read as NULL, as they would by default
+            cursor.copy_expert("COPY %s (%s) FROM STDIN "
+                               "WITH (FORMAT csv, NULL '\\N')" %
+                               (staging, fields), buf)
+            if model is Update:
+                # Parent trips were stored just before, in this transaction
+                trip = quote(Trip._meta.db_table)
+                cursor.execute(
+                        "INSERT INTO %s (%s, valid_until, parent_trip_id) "
+                        "SELECT %s, %d, trip.id FROM %s staging "
+                        "LEFT JOIN %s trip ON trip.trip_id = staging.trip_id "
+                        "AND trip.retrieval = staging.retrieval "
+                        "ON CONFLICT DO NOTHING" % (
+                            table, fields,
+                            ', '.join('staging.' + name for name in names),
+                            valid_until, staging, trip))
+                # Rows inserted, without the conflicts
+                return cursor.rowcount
+            cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s "
+                           "ON CONFLICT DO NOTHING" % (
+                               table, fields, fields, staging))
+            inserted = cursor.rowcount
+            self._upsert_current(
+                    cursor, columns.dtype.names,
+                    "SELECT DISTINCT ON (trip_id) %s FROM %s "
+                    "ORDER BY trip_id, retrieval DESC" % (fields, staging))
+            return inserted
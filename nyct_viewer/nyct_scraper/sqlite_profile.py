@@ -0,0 +1,44 @@
+# Single-node storage on SQLite, for deployments without a database
+# server. Selected with NYCT_DATABASE=sqlite, see settings.py. Every new
+# SQLite connection is switched to WAL mode, so that the web workers keep
+# reading while the scraper writes, and given the pragmas below. The
+# scraper stores one transaction per snapshot, see SnapshotWriter.
+import logging
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    # In WAL mode only checkpoints sync to disk: a power loss can lose the
+    # last snapshots, but never corrupts the database
+    ('synchronous', 'NORMAL'),
+    # 64 MiB of page cache (negative sizes are in KiB)
+    ('cache_size', -65536),
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', 256 * 1024 * 1024),
+    # Checkpoint every 4000 pages (16 MiB) instead of every 1000, a
+    # snapshot is then rarely held up by one
+    ('wal_autocheckpoint', 4000),
+)
+# ON CONFLICT DO UPDATE, for the CurrentTrip upserts
+MIN_VERSION = (3, 24, 0)
+
+
+def configure(sender, connection, **kwargs):
+    ''' connection_created receiver '''
+    if connection.vendor != 'sqlite':
+        return
+    if connection.Database.sqlite_version_info < MIN_VERSION:
+        raise ImproperlyConfigured(
+                "SQLite %s is too old, %s or later is needed" % (
+                    connection.Database.sqlite_version,
+                    '.'.join(str(part) for part in MIN_VERSION)))
+    with connection.cursor() as cursor:
+        for name, value in PRAGMAS:
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.execute("PRAGMA journal_mode")
+        mode = cursor.fetchone()[0]
+    if mode != 'wal':
+        # In-memory databases, used by tests, cannot be
+        logger.debug("SQLite database in %s journal mode", mode)
@@ -0,0 +1,46 @@
+import csv
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SymbolTable(object):
+    ''' Interns identifier strings (stop, route and trip ids) as small
+    integer codes, so that records hold one shared string per identifier
+    instead of a fresh copy per cycle. Codes are only meaningful within
+    the process that assigned them. '''
+    def __init__(self):
+        self._codes = {}
+        self.strings = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, string):
+        code = self._codes.get(string)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(string)
+                if code is None:
+                    code = len(self.strings)
+                    self.strings.append(string)
+                    self._codes[string] = code
+        return code
+
+    def decode(self, code):
+        return self.strings[code]
+
+    def seed(self, path, column):
+        ''' Encode every value of column in a GTFS csv file '''
+        try:
+            with open(path, newline='') as fil:
+                for row in csv.DictReader(fil):
+                    self.encode(row[column])
+        except (IOError, KeyError):
+            logger.warning("Could not seed symbols from %s", path)
+
+
+# Shared by everything in this process
+SYMBOLS = SymbolTable()
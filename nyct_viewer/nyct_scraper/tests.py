@@ -0,0 +1,710 @@
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from google.protobuf.message import DecodeError
+from . import gtfs_realtime_pb2
+from . import nyct_subway_pb2
+from .alerts import AlertIndex
+from .cancellations import TIMEZONE, CancellationDetector
+from .circuit_breaker import CircuitBreaker
+from .feed_diff import SnapshotDiff
+from .feed_records import TripRecord, UpdateRecord, parse_payload
+from .feed_scheduler import FeedScheduler
+from .feed_wire import decode_payload
+from .models import CurrentTrip, Trip, Update
+from .prediction_capture import PredictionCapture
+from .snapshot_writer import SnapshotWriter
+from .symbols import SYMBOLS
+from .write_behind import COALESCE, DROP_OLDEST, WriteBehind
+
+TIMESTAMP = 1500000000
+# Field 100, varint 1: known to neither gtfs-realtime.proto nor the NYCT
+# extensions
+UNKNOWN_FIELD = b'\xa0\x06\x01'
+
+
+def feed_message():
+    ''' A small NYCT feed, with an alert that precedes the trip it names '''
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = TIMESTAMP
+    nyct_header = feed.header.Extensions[nyct_subway_pb2.nyct_feed_header]
+    nyct_header.nyct_subway_version = '1.0'
+    period = nyct_header.trip_replacement_period.add()
+    period.route_id = '1'
+    period.replacement_period.end = TIMESTAMP + 1800
+    entity = feed.entity.add()
+    entity.id = '1'
+    alert = entity.alert
+    alert.header_text.translation.add().text = 'Delays'
+    alert.informed_entity.add().trip.trip_id = '000650_1..N'
+    alert.informed_entity.add().route_id = '1'
+    entity = feed.entity.add()
+    entity.id = '2'
+    trip = entity.trip_update.trip
+    trip.trip_id = '000650_1..N'
+    trip.route_id = '1'
+    nyct_trip = trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
+    nyct_trip.train_id = '01 0106+ 242/SFY'
+    nyct_trip.is_assigned = True
+    nyct_trip.direction = 3
+    for i in range(3):
+        stop_time = entity.trip_update.stop_time_update.add()
+        stop_time.stop_id = '1%02dN' % (i + 1)
+        stop_time.arrival.time = TIMESTAMP + 90 * i
+        stop_time.departure.time = TIMESTAMP + 90 * i + 30
+        nyct_update = stop_time.Extensions[
+                nyct_subway_pb2.nyct_stop_time_update]
+        nyct_update.scheduled_track = '1'
+        nyct_update.actual_track = '2'
+    entity = feed.entity.add()
+    entity.id = '3'
+    entity.vehicle.trip.CopyFrom(trip)
+    entity.vehicle.current_stop_sequence = 4
+    entity.vehicle.timestamp = TIMESTAMP - 10
+    return feed
+
+
+def trip_record(trip_id, retrieval=TIMESTAMP, route_id='1', **fields):
+    trip = TripRecord(SYMBOLS.encode(trip_id), SYMBOLS.encode(route_id),
+                      retrieval)
+    trip.is_assigned = True
+    for name, value in fields.items():
+        setattr(trip, name, value)
+    return trip
+
+
+def update_record(trip_id, stop, arrival, retrieval=TIMESTAMP):
+    return UpdateRecord(SYMBOLS.encode(trip_id), SYMBOLS.encode(stop),
+                        arrival, arrival + 30, 0, '1', '1', retrieval)
+
+
+class WireDecoderTest(SimpleTestCase):
+    ''' decode_payload must agree with parse_payload, which goes through
+    the generated protobuf classes '''
+
+    def assertDecodesAlike(self, content):
+        expected = parse_payload(content)
+        actual = decode_payload(content)
+        self.assertEqual(actual[0], expected[0])
+        self.assertEqual(actual[1], expected[1])
+        self.assertEqual(actual[2], expected[2])
+        self.assertEqual([trip.values() for trip in actual[3]],
+                         [trip.values() for trip in expected[3]])
+        self.assertEqual([update.values() for update in actual[4]],
+                         [update.values() for update in expected[4]])
+        self.assertEqual(actual[5], expected[5])
+        return actual
+
+    def test_feed(self):
+        timestamp, periods, alerts, trips, updates, unknown = \
+            self.assertDecodesAlike(feed_message().SerializeToString())
+        self.assertEqual(timestamp, TIMESTAMP)
+        self.assertEqual(periods, {'1': TIMESTAMP + 1800})
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(len(trips), 1)
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(updates[1].actual_track, '2')
+        self.assertEqual(unknown, [])
+
+    def test_proto2_defaults(self):
+        # Neither current_status nor the NYCT direction are set
+        feed = feed_message()
+        vehicle = feed.entity.add()
+        vehicle.id = '4'
+        vehicle.vehicle.trip.trip_id = '000700_2..S'
+        vehicle.vehicle.trip.route_id = '2'
+        vehicle.vehicle.trip.Extensions[
+            nyct_subway_pb2.nyct_trip_descriptor].train_id = '02 0107+ 241/FLA'
+        trips = self.assertDecodesAlike(feed.SerializeToString())[3]
+        trip = trips[-1]
+        self.assertEqual(trip.trip_id, '000700_2..S')
+        self.assertEqual(
+            trip.current_status,
+            gtfs_realtime_pb2.VehiclePosition.IN_TRANSIT_TO)
+        self.assertEqual(trip.direction,
+                         nyct_subway_pb2.NyctTripDescriptor.NORTH)
+
+    def test_unknown_fields(self):
+        feed = feed_message()
+        stop_time = feed.entity[1].trip_update.stop_time_update[0]
+        stop_time.MergeFromString(UNKNOWN_FIELD)
+        feed.entity[2].vehicle.MergeFromString(UNKNOWN_FIELD)
+        content = feed.SerializeToString() + UNKNOWN_FIELD
+        self.assertDecodesAlike(content)
+
+    def test_unknown_entities(self):
+        # Neither a trip update, a vehicle nor an alert
+        feed = feed_message()
+        feed.entity.add().id = '4'
+        unknown = self.assertDecodesAlike(feed.SerializeToString())[5]
+        self.assertEqual(len(unknown), 1)
+
+    def test_alert_before_trip(self):
+        # parse_payload only flags trips named by a later alert
+        feed = feed_message()
+        feed.entity.add().CopyFrom(feed.entity[0])
+        trips = self.assertDecodesAlike(feed.SerializeToString())[3]
+        self.assertTrue(trips[0].alert)
+
+    def test_truncated(self):
+        content = feed_message().SerializeToString()
+        with self.assertRaises(DecodeError):
+            decode_payload(content[:len(content) * 2 // 3])
+
+    def test_invalid_utf8(self):
+        feed = feed_message()
+        feed.entity[1].trip_update.trip.trip_id = 'X' * 8
+        content = feed.SerializeToString().replace(b'X' * 8, b'\xff' * 8)
+        with self.assertRaises(DecodeError):
+            decode_payload(content)
+
+
+class SnapshotDiffTest(SimpleTestCase):
+
+    def setUp(self):
+        self.differ = SnapshotDiff()
+        self.differ.diff([trip_record('A', curr_stop='101N'),
+                          trip_record('B', curr_stop='102N'),
+                          trip_record('C', curr_stop='103N')],
+                         [update_record('A', '101N', TIMESTAMP + 60),
+                          update_record('B', '102N', TIMESTAMP + 60)])
+
+    def test_first_snapshot_is_added(self):
+        changes = SnapshotDiff().diff([trip_record('A')],
+                                      [update_record('A', '101N', 0)])
+        self.assertEqual(len(changes.added), 1)
+        self.assertEqual(len(changes.updates_added), 1)
+        self.assertEqual(len(changes), 2)
+
+    def test_trips(self):
+        changes = self.differ.diff(
+                [trip_record('A', curr_stop='102N'),
+                 trip_record('B', curr_stop='102N', next_stop_time=5),
+                 trip_record('D')], [])
+        self.assertEqual([trip.trip_id for trip in changes.moved], ['A'])
+        self.assertEqual([trip.trip_id for trip in changes.predicted],
+                         ['B'])
+        self.assertEqual([trip.trip_id for trip in changes.added], ['D'])
+        self.assertEqual([trip.trip_id for trip in changes.removed], ['C'])
+        self.assertEqual([trip.trip_id for trip in changes.trips],
+                         ['D', 'A', 'B'])
+
+    def test_timestamp_and_retrieval_are_not_compared(self):
+        changes = self.differ.diff(
+                [trip_record('A', TIMESTAMP + 30, curr_stop='101N',
+                             timestamp=TIMESTAMP + 20),
+                 trip_record('B', TIMESTAMP + 30, curr_stop='102N'),
+                 trip_record('C', TIMESTAMP + 30, curr_stop='103N')],
+                [update_record('A', '101N', TIMESTAMP + 60, TIMESTAMP + 30),
+                 update_record('B', '102N', TIMESTAMP + 60, TIMESTAMP + 30)])
+        self.assertEqual(len(changes), 0)
+
+    def test_updates(self):
+        changes = self.differ.diff(
+                [], [update_record('A', '101N', TIMESTAMP + 90),
+                     update_record('A', '102N', TIMESTAMP + 150)])
+        self.assertEqual([(u.trip_id, u.stop)
+                          for u in changes.updates_changed], [('A', '101N')])
+        self.assertEqual([(u.trip_id, u.stop)
+                          for u in changes.updates_added], [('A', '102N')])
+        self.assertEqual([(u.trip_id, u.stop)
+                          for u in changes.updates_removed], [('B', '102N')])
+        self.assertEqual(len(changes.removed), 3)
+
+
+def alert_entity(alert_id, trips=(), routes=(), stops=(), start=0, end=0):
+    entity = gtfs_realtime_pb2.FeedEntity()
+    entity.id = alert_id
+    alert = entity.alert
+    alert.header_text.translation.add().text = 'Delays'
+    if start or end:
+        period = alert.active_period.add()
+        period.start = start
+        period.end = end
+    for trip_id, route_id in trips:
+        selector = alert.informed_entity.add()
+        selector.trip.trip_id = trip_id
+        selector.route_id = route_id
+    for route_id in routes:
+        alert.informed_entity.add().route_id = route_id
+    for stop_id in stops:
+        alert.informed_entity.add().stop_id = stop_id
+    return entity.SerializeToString()
+
+
+class AlertIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = AlertIndex()
+
+    def test_trip_alert_spares_its_route(self):
+        self.index.update('1', [alert_entity('1', [('000650_1..N', '1')])],
+                          TIMESTAMP)
+        self.assertTrue(self.index.affects(trip_record('000650_1..N')))
+        self.assertFalse(self.index.affects(trip_record('000700_1..N')))
+
+    def test_route_alert(self):
+        self.index.update('1', [alert_entity('1', routes=['2'])], TIMESTAMP)
+        self.assertTrue(self.index.affects(trip_record('000700_2..S',
+                                                       route_id='2')))
+        self.assertFalse(self.index.affects(trip_record('000700_1..S')))
+
+    def test_alerts_of_every_line(self):
+        self.index.update('1', [alert_entity('1', routes=['A'])], TIMESTAMP)
+        self.index.update('ace', [], TIMESTAMP)
+        self.assertTrue(self.index.affects(trip_record('000700_A..S',
+                                                       route_id='A')))
+
+    def test_stop_alert(self):
+        self.index.update('1', [alert_entity('1', stops=['101'])],
+                          TIMESTAMP)
+        self.assertEqual(len(self.index.for_stop('101N')), 1)
+        self.assertEqual(self.index.for_stop('102N'), [])
+
+    def test_unchanged(self):
+        entities = [alert_entity('1', routes=['1'])]
+        self.assertTrue(self.index.update('1', entities, TIMESTAMP))
+        self.assertFalse(self.index.update('1', entities, TIMESTAMP + 30))
+        self.assertTrue(self.index.update('1', [], TIMESTAMP + 60))
+        self.assertEqual(self.index.by_route, {})
+
+    def test_active_period(self):
+        entities = [alert_entity('1', routes=['1'], start=TIMESTAMP + 60,
+                                 end=TIMESTAMP + 120)]
+        self.index.update('1', entities, TIMESTAMP)
+        self.assertEqual(self.index.for_route('1'), [])
+        # Not parsed again, but the index is rebuilt once the alert starts
+        # and once it ends
+        self.assertFalse(self.index.update('1', entities, TIMESTAMP + 30))
+        self.assertTrue(self.index.update('1', entities, TIMESTAMP + 60))
+        self.assertEqual(len(self.index.for_route('1')), 1)
+        self.assertTrue(self.index.update('1', entities, TIMESTAMP + 120))
+        self.assertEqual(self.index.for_route('1'), [])
+        self.assertFalse(self.index.update('1', entities, TIMESTAMP + 180))
+
+
+class WriteBehindTest(SimpleTestCase):
+    ''' The first snapshot submitted is held in write() until release is
+    set, the following ones queue behind it '''
+
+    def setUp(self):
+        self.writes = []
+        self.lost = []
+        self.failures = 0
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, trips, updates, closes, removed):
+        self.writing.set()
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database down")
+        self.writes.append((trips, updates, closes, removed))
+
+    def on_lost(self, updates, closes):
+        self.lost.append((updates, closes))
+
+    def start(self, policy=COALESCE, **kwargs):
+        writer = WriteBehind(self.write, policy, queue_size=2,
+                             on_lost=self.on_lost, **kwargs)
+        self.addCleanup(self.release.set)
+        writer.submit(['t0'], [])
+        self.assertTrue(self.writing.wait(5))
+        return writer
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_coalesce(self):
+        writer = self.start()
+        for trip in ('t1', 't2', 't3'):
+            writer.submit([trip], [trip + 'u'], [trip + 'c'])
+        self.assertEqual(writer.pending, 2)
+        self.assertEqual(writer.pending_rows, 6)
+        self.assertEqual(writer.coalesced, 1)
+        self.release.set()
+        writer.close()
+        self.assertEqual(self.writes[1], (['t1', 't2', 't3'],
+                                          ['t1u', 't2u', 't3u'],
+                                          ['t1c', 't2c', 't3c'], []))
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(writer.dropped, 0)
+        self.assertEqual(self.lost, [])
+
+    def test_drop_oldest(self):
+        writer = self.start(DROP_OLDEST)
+        writer.submit(['t1'], ['t1u'], ['t1c'], ['r1'])
+        writer.submit(['t2'], [])
+        with self.assertLogs('nyct_scraper.write_behind', 'WARNING'):
+            writer.submit(['t3'], [])
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(self.lost, [(['t1u'], ['t1c'])])
+        self.release.set()
+        writer.close()
+        # The trips removed by the snapshot dropped are still removed
+        self.assertEqual(self.writes[1], (['t2', 't3'], [], [], ['r1']))
+
+    def test_max_rows(self):
+        writer = self.start(max_rows=3)
+        writer.submit(['t1', 't2'], [])
+        with self.assertLogs('nyct_scraper.write_behind', 'WARNING'):
+            writer.submit(['t3', 't4'], [])
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.pending_rows, 2)
+        self.release.set()
+        writer.close()
+        self.assertEqual(self.writes[1][0], ['t3', 't4'])
+
+    @mock.patch.object(WriteBehind, 'BACKOFF', 0.001)
+    def test_retry(self):
+        self.failures = 2
+        writer = self.start()
+        with self.assertLogs('nyct_scraper.write_behind', 'ERROR'):
+            self.release.set()
+            self.wait_for(lambda: writer.written)
+        writer.close()
+        self.assertEqual(writer.retries, 2)
+        self.assertEqual(writer.failed, 0)
+        self.assertEqual(self.writes, [(['t0'], [], [], [])])
+
+    @mock.patch.object(WriteBehind, 'BACKOFF', 0.001)
+    def test_give_up(self):
+        self.failures = WriteBehind.RETRIES + 1
+        writer = WriteBehind(self.write, on_lost=self.on_lost)
+        self.release.set()
+        with self.assertLogs('nyct_scraper.write_behind', 'ERROR'):
+            writer.submit(['t0'], ['t0u'], [], ['r0'])
+            self.wait_for(lambda: self.lost)
+        self.assertEqual(writer.retries, WriteBehind.RETRIES)
+        self.assertEqual(self.lost, [(['t0u'], [])])
+        writer.submit(['t1'], [])
+        writer.close()
+        # The trips removed by the snapshot given up go with the next one
+        self.assertEqual(self.writes, [(['t1'], [], [], ['r0'])])
+
+
+class PredictionCaptureTest(TestCase):
+
+    def setUp(self):
+        self.capture = PredictionCapture()
+
+    def test_previous_run(self):
+        def update(trip_id, retrieval, valid_until=0):
+            return Update(trip_id=trip_id, stop='101N', arrival=TIMESTAMP,
+                          departure=TIMESTAMP + 30, schedule_relationship=0,
+                          actual_track='1', scheduled_track='1',
+                          retrieval=retrieval, valid_until=valid_until)
+        Update.objects.bulk_create([
+            update('A', TIMESTAMP - 60), update('A', TIMESTAMP - 30),
+            update('B', TIMESTAMP - 30),
+            update('C', TIMESTAMP - 30, Update.NOT_CAPTURED)])
+        changed, closes = self.capture.capture(
+                [update_record('A', '101N', TIMESTAMP)])
+        # A is unchanged since the last row stored. The older open row of
+        # A was left behind by an interrupted run, B is no longer in the
+        # feeds and C was not captured.
+        self.assertEqual(changed, [])
+        self.assertEqual(sorted(closes), [
+            ('A', '101N', TIMESTAMP - 60, TIMESTAMP - 30),
+            ('B', '101N', TIMESTAMP - 30, TIMESTAMP)])
+
+    def test_capture(self):
+        a = update_record('A', '101N', TIMESTAMP + 60)
+        b = update_record('B', '101N', TIMESTAMP + 60)
+        changed, closes = self.capture.capture([a, b])
+        self.assertEqual(changed, [a, b])
+        self.assertEqual(closes, [])
+        later = TIMESTAMP + 30
+        b = update_record('B', '101N', TIMESTAMP + 90, later)
+        changed, closes = self.capture.capture(
+                [update_record('A', '101N', TIMESTAMP + 60, later), b])
+        self.assertEqual(changed, [b])
+        self.assertEqual(closes, [('B', '101N', TIMESTAMP, later)])
+        c = update_record('C', '101N', TIMESTAMP + 60, later)
+        changed, closes = self.capture.capture([c], [b])
+        self.assertEqual(changed, [c])
+        self.assertEqual(closes, [('B', '101N', later, later)])
+        self.assertEqual(self.capture.captured, 4)
+        self.assertEqual(self.capture.skipped, 1)
+
+    def test_rollback(self):
+        self.capture.capture([update_record('A', '101N', TIMESTAMP + 60)])
+        changed, closes = self.capture.capture(
+                [update_record('A', '101N', TIMESTAMP + 90, TIMESTAMP + 30)])
+        with self.assertLogs('nyct_scraper.prediction_capture', 'WARNING'):
+            self.capture.rollback(changed, closes)
+        # The row stored first is still the open one: the prediction is
+        # captured again, and closes it
+        a = update_record('A', '101N', TIMESTAMP + 90, TIMESTAMP + 60)
+        changed, closes = self.capture.capture([a])
+        self.assertEqual(changed, [a])
+        self.assertEqual(closes, [('A', '101N', TIMESTAMP, TIMESTAMP + 60)])
+
+    def test_rollback_removed(self):
+        a = update_record('A', '101N', TIMESTAMP + 60)
+        self.capture.capture([a])
+        changed, closes = self.capture.capture(
+                [update_record('B', '101N', TIMESTAMP + 60, TIMESTAMP + 30)],
+                [a])
+        with self.assertLogs('nyct_scraper.prediction_capture', 'WARNING'):
+            self.capture.rollback(changed, closes)
+        # Closes that were not stored are returned again
+        changed, closes = self.capture.capture([])
+        self.assertEqual(changed, [])
+        self.assertEqual(closes, [('A', '101N', TIMESTAMP, TIMESTAMP + 30)])
+
+
+@mock.patch.object(FeedScheduler, 'JITTER', 0.0)
+class FeedSchedulerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = time.time() + 1
+
+    def test_budget(self):
+        scheduler = FeedScheduler(['1', 'ace', 'g'], budget=2)
+        self.assertEqual(scheduler.due(self.now), ['1', 'ace'])
+        self.assertEqual(scheduler.next_poll['1'],
+                         self.now + FeedScheduler.RETRY)
+        # Half a minute refills a token, for the most overdue line
+        self.assertEqual(scheduler.due(self.now + 30), ['g'])
+
+    def test_update(self):
+        scheduler = FeedScheduler(['1'])
+        self.assertTrue(scheduler.update('1', TIMESTAMP, TIMESTAMP + 1))
+        self.assertEqual(scheduler.next_poll['1'],
+                         TIMESTAMP + FeedScheduler.DEFAULT_PERIOD +
+                         FeedScheduler.DELAY)
+        # Not republished yet
+        self.assertFalse(scheduler.update('1', TIMESTAMP, TIMESTAMP + 33))
+        self.assertEqual(scheduler.next_poll['1'],
+                         TIMESTAMP + 33 + FeedScheduler.RETRY)
+        self.assertTrue(scheduler.update('1', TIMESTAMP + 20,
+                                         TIMESTAMP + 36))
+        self.assertEqual(scheduler.period['1'], 27.0)
+        self.assertEqual(scheduler.next_poll['1'],
+                         TIMESTAMP + 20 + 27.0 + FeedScheduler.DELAY)
+        # Never sooner than MIN_PERIOD from now, whatever the clocks say
+        scheduler.update('1', TIMESTAMP + 40, TIMESTAMP + 600)
+        self.assertEqual(scheduler.next_poll['1'],
+                         TIMESTAMP + 600 + FeedScheduler.MIN_PERIOD)
+
+    def test_failed(self):
+        scheduler = FeedScheduler(['1'])
+        delays = [scheduler.failed('1', self.now) for _ in range(9)]
+        self.assertEqual(delays, [3.0, 6.0, 12.0, 24.0, 48.0, 96.0, 192.0,
+                                  300.0, 300.0])
+        self.assertEqual(scheduler.next_poll['1'], self.now + 300.0)
+        scheduler.update('1', TIMESTAMP, self.now)
+        self.assertEqual(scheduler.failed('1', self.now), 3.0)
+
+    def test_cooldown(self):
+        scheduler = FeedScheduler(['1', 'ace'], budget=2)
+        cooldown = {'1': 60.0}
+        self.assertEqual(
+            scheduler.due(self.now, lambda line: cooldown.get(line, 0.0)),
+            ['ace'])
+        self.assertEqual(scheduler._tokens, 1.0)
+        # Polled once the circuit lets a trial through
+        self.assertEqual(scheduler.next_poll['1'], self.now + 60)
+        self.assertEqual(scheduler.due(self.now + 60), ['ace', '1'])
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('1')
+
+    def open(self):
+        with self.assertLogs('nyct_scraper.circuit_breaker', 'WARNING'):
+            for _ in range(CircuitBreaker.THRESHOLD):
+                self.breaker.failure()
+
+    def expire(self):
+        self.breaker.opened -= CircuitBreaker.COOLDOWN
+
+    def test_threshold(self):
+        for _ in range(CircuitBreaker.THRESHOLD - 1):
+            self.breaker.failure()
+        self.assertFalse(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.remaining(), 0.0)
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.is_open)
+
+    def test_open(self):
+        self.open()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.assertGreater(self.breaker.remaining(),
+                           CircuitBreaker.COOLDOWN - 5)
+        self.expire()
+        self.assertEqual(self.breaker.remaining(), 0.0)
+
+    def test_trial_fails(self):
+        self.open()
+        self.expire()
+        self.assertTrue(self.breaker.allow())
+        # A single trial at a time
+        self.assertFalse(self.breaker.allow())
+        with self.assertLogs('nyct_scraper.circuit_breaker', 'WARNING'):
+            self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertGreater(self.breaker.remaining(),
+                           CircuitBreaker.COOLDOWN - 5)
+
+    def test_trial_succeeds(self):
+        self.open()
+        self.expire()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+        self.assertTrue(self.breaker.allow())
+
+
+class SnapshotWriterTest(TestCase):
+
+    def setUp(self):
+        self.writer = SnapshotWriter()
+
+    def current(self):
+        return dict(CurrentTrip.objects.values_list('trip_id', 'retrieval'))
+
+    def test_write(self):
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            rows = self.writer.write(
+                    [trip_record('A'), trip_record('B')],
+                    [update_record('A', '101N', TIMESTAMP + 60)])
+        self.assertEqual(rows, 3)
+        self.assertEqual(Trip.objects.count(), 2)
+        update = Update.objects.get()
+        self.assertEqual(update.parent_trip,
+                         Trip.objects.get(trip_id='A'))
+        self.assertEqual(update.valid_until, Update.NOT_CAPTURED)
+        self.assertEqual(self.current(), {'A': TIMESTAMP, 'B': TIMESTAMP})
+
+    def test_already_stored(self):
+        trips = [trip_record('A'), trip_record('B')]
+        updates = [update_record('A', '101N', TIMESTAMP + 60)]
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            self.writer.write(trips, updates)
+            rows = self.writer.write(trips + [trip_record('C')], updates)
+        self.assertEqual(rows, 1)
+        self.assertEqual(self.writer.last_rows, 1)
+        self.assertEqual(self.writer.last_skipped, 3)
+        self.assertEqual(self.writer.rows, 4)
+        self.assertEqual(self.writer.skipped, 3)
+        self.assertEqual(Trip.objects.count(), 3)
+
+    def test_current_trip(self):
+        later = TIMESTAMP + 30
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            self.writer.write([trip_record('A'), trip_record('B')], [])
+            self.writer.write([trip_record('A', later, curr_stop='102N')],
+                              [], removed=[('B', TIMESTAMP)])
+            # An older state never replaces a later one
+            self.writer.write([trip_record('A')], [])
+        self.assertEqual(self.current(), {'A': later})
+        self.assertEqual(CurrentTrip.objects.get().curr_stop, '102N')
+
+    def test_removed_came_back(self):
+        later = TIMESTAMP + 30
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            self.writer.write([trip_record('A'), trip_record('B')], [])
+            # Removed up to TIMESTAMP, seen again since in the same batch
+            self.writer.write([trip_record('B', later)], [],
+                              removed=[('B', TIMESTAMP)])
+        self.assertEqual(self.current(), {'A': TIMESTAMP, 'B': later})
+
+    def test_purge(self):
+        CurrentTrip.objects.create(trip_id='X', route_id='1')
+        CurrentTrip.objects.create(trip_id='Y', route_id='2')
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            self.writer.write([trip_record('A')], [])
+            # Only the first snapshot of a route replaces its trips
+            CurrentTrip.objects.create(trip_id='Z', route_id='1')
+            self.writer.write([trip_record('A', TIMESTAMP + 30)], [])
+        self.assertEqual(sorted(self.current()), ['A', 'Y', 'Z'])
+
+    def test_cdc(self):
+        writer = SnapshotWriter(cdc=True)
+        later = TIMESTAMP + 30
+        with self.assertLogs('nyct_scraper.snapshot_writer', 'INFO'):
+            writer.write([trip_record('A')],
+                         [update_record('A', '101N', TIMESTAMP + 60)])
+            writer.write([trip_record('A', later)],
+                         [update_record('A', '101N', TIMESTAMP + 90, later)],
+                         [('A', '101N', TIMESTAMP, later)])
+        self.assertEqual(
+            list(Update.objects.order_by('retrieval').values_list(
+                'retrieval', 'valid_until')),
+            [(TIMESTAMP, later), (later, 0)])
+
+
+# Weekday service, and Saturday service that a holiday replaces
+GTFS = {
+    'calendar.txt': (
+        'service_id,monday,tuesday,wednesday,thursday,friday,saturday,'
+        'sunday,start_date,end_date\n'
+        'WKD,1,1,1,1,1,0,0,20240101,20241231\n'
+        'SAT,0,0,0,0,0,1,0,20240101,20241231\n'),
+    'calendar_dates.txt': (
+        'service_id,date,exception_type\n'
+        'SAT,20240316,2\n'
+        'WKD,20240316,1\n'),
+    'trips.txt': (
+        'route_id,service_id,trip_id\n'
+        '1,WKD,WKD-143000_1..N03R\n'
+        '1,WKD,WKD-146000_1..N03R\n'
+        '1,SAT,SAT-004000_1..N03R\n'),
+    'stop_times.txt': (
+        'trip_id,departure_time,stop_sequence\n'
+        'WKD-143000_1..N03R,23:50:00,1\n'
+        'WKD-146000_1..N03R,24:20:00,1\n'
+        'WKD-146000_1..N03R,24:30:00,2\n'
+        'SAT-004000_1..N03R,00:40:00,1\n'),
+}
+
+
+class CancellationDetectorTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with tempfile.TemporaryDirectory() as path:
+            for name, content in GTFS.items():
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(content)
+            cls.detector = CancellationDetector(path)
+
+    def detect(self, day, observed=()):
+        ''' From 00:10 to 00:50 in the night from Friday to day '''
+        now = datetime(2024, 3, day, 0, 10, tzinfo=TIMEZONE).timestamp()
+        return self.detector.detect(
+                now, {'1': now + 2400},
+                [trip_record(trip_id) for trip_id in observed])
+
+    def test_service_day_boundary(self):
+        # Friday's trip after midnight and Saturday's first trip
+        self.assertEqual(self.detect(9),
+                         {'1': ['004000_1..N', '146000_1..N']})
+        self.assertEqual(self.detect(9, ['146000_1..N']),
+                         {'1': ['004000_1..N']})
+        self.assertEqual(self.detect(9, ['146000_1..N', '004000_1..N']), {})
+
+    def test_exceptions(self):
+        # No Saturday service on the 16th, but weekday service, which runs
+        # after midnight into Sunday
+        self.assertEqual(self.detect(16), {'1': ['146000_1..N']})
+        self.assertEqual(self.detect(17), {'1': ['146000_1..N']})
+        self.assertEqual(self.detect(18), {})
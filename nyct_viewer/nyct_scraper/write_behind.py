@@ -0,0 +1,226 @@
+import collections
+import logging
+import threading
+import time
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+COALESCE = 'coalesce'
+DROP_OLDEST = 'drop_oldest'
+
+
+def _rows(entry):
+    return len(entry[1]) + len(entry[2])
+
+
+class WriteBehind(threading.Thread):
+    ''' Stores snapshots on a dedicated thread, so that publishing them
+    never waits on the database.
+
+    submit() only queues (trips, updates, closes, removed); the thread hands
+    everything pending to write() as one batch. At most QUEUE_SIZE
+    snapshots wait, after that the policy decides: COALESCE merges the new
+    snapshot into the newest pending one, so nothing is lost but batches
+    grow until the writer catches up; DROP_OLDEST discards the oldest
+    pending snapshot. Either way at most max_rows trips and updates are
+    held: past that the oldest snapshots are dropped, whatever the policy.
+
+    A batch that fails is queued again and retried after BACKOFF seconds,
+    twice as long after every further failure, up to RETRIES times; then
+    it is given up (failed). on_lost(updates, closes) is called for every
+    snapshot dropped or given up, its trips removed are kept for the next
+    write.
+
+    Lag is the time from submit() to the end of the write that stored the
+    snapshot: last_lag and max_lag, and lag for the oldest snapshot still
+    waiting.
+
+    With a ConnectionPool, writes happen under its leases and the thread
+    connects as soon as it starts. '''
+    QUEUE_SIZE = 8
+    MAX_ROWS = 200000
+    # Snapshots written together at most, when several are pending
+    MAX_BATCH = 4
+    RETRIES = 5
+    BACKOFF = 1.0
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, write, policy=COALESCE, queue_size=None, pool=None,
+                 max_rows=None, on_lost=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if policy not in (COALESCE, DROP_OLDEST):
+            raise ValueError("Unknown write-behind policy %r" % policy)
+        self.write = write
+        self.policy = policy
+        self.queue_size = queue_size or WriteBehind.QUEUE_SIZE
+        self.max_rows = max_rows or WriteBehind.MAX_ROWS
+        self.pool = pool
+        self.on_lost = on_lost
+        # [submit time, trips, updates, closes, removed, failed attempts],
+        # oldest first
+        self._pending = collections.deque()
+        self._rows = 0
+        # Trips removed by snapshots given up, while none is pending
+        self._removed = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.start()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def pending_rows(self):
+        ''' Trips and updates waiting to be written '''
+        return self._rows
+
+    @property
+    def lag(self):
+        ''' Seconds the oldest pending snapshot has been waiting '''
+        with self._cond:
+            if not self._pending:
+                return 0.0
+            return time.time() - self._pending[0][0]
+
+    def submit(self, trips, updates, closes=(), removed=()):
+        entry = [time.time(), list(trips), list(updates), list(closes),
+                 list(removed), 0]
+        dropped = []
+        with self._cond:
+            entry[4][:0] = self._removed
+            self._removed = []
+            if (len(self._pending) >= self.queue_size and
+                    self.policy == COALESCE):
+                # Keeps the submit time of the older snapshot, the lag is
+                # that of the oldest row in the batch
+                newest = self._pending[-1]
+                for rows, new in zip(newest[1:5], entry[1:5]):
+                    rows.extend(new)
+                self.coalesced += 1
+            else:
+                self._pending.append(entry)
+            self._rows += _rows(entry)
+            while len(self._pending) > self.queue_size:
+                dropped.append(self._drop_oldest())
+            while self._rows > self.max_rows and len(self._pending) > 1:
+                dropped.append(self._drop_oldest())
+            self._cond.notify()
+        if dropped:
+            logger.warning("Write-behind queue full, dropped %d snapshots "
+                           "so far", self.dropped)
+            self._lost(dropped)
+
+    def close(self):
+        ''' Write what is still pending, then stop '''
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self.join()
+
+    def _drop_oldest(self):
+        # Called with the lock held, and another snapshot pending
+        entry = self._pending.popleft()
+        self._rows -= _rows(entry)
+        self.dropped += 1
+        # Its removed trips are kept: left out, they would stay in
+        # CurrentTrip for good
+        self._pending[0][4][:0] = entry[4]
+        return entry
+
+    def _lost(self, entries):
+        if self.on_lost is None:
+            return
+        for entry in entries:
+            try:
+                self.on_lost(entry[2], entry[3])
+            except:
+                logger.exception("")
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closing:
+                self._cond.wait()
+            batch = []
+            while self._pending and len(batch) < WriteBehind.MAX_BATCH:
+                batch.append(self._pending.popleft())
+                self._rows -= _rows(batch[-1])
+            return batch
+
+    def _retry(self, batch):
+        ''' Queue a failed batch again, or give it up '''
+        attempts = max(entry[5] for entry in batch) + 1
+        with self._cond:
+            if attempts <= WriteBehind.RETRIES:
+                for entry in reversed(batch):
+                    entry[5] = attempts
+                    self._pending.appendleft(entry)
+                    self._rows += _rows(entry)
+                self.retries += 1
+                # submit() notifies at feed cadence: only close() may cut
+                # the backoff short
+                deadline = time.monotonic() + min(
+                        WriteBehind.BACKOFF * 2 ** (attempts - 1),
+                        WriteBehind.MAX_BACKOFF)
+                while not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                return
+            self.failed += len(batch)
+            # Its removed trips go with the next snapshot
+            removed = [trip for entry in batch for trip in entry[4]]
+            if self._pending:
+                self._pending[0][4][:0] = removed
+            else:
+                self._removed[:0] = removed
+        logger.error("Gave up writing %d snapshots after %d attempts, %d "
+                     "so far", len(batch), attempts, self.failed)
+        self._lost(batch)
+
+    def run(self):
+        if self.pool is not None:
+            self.pool.warm()
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    break
+                trips = []
+                updates = []
+                closes = []
+                removed = []
+                for _, batch_trips, batch_updates, batch_closes, \
+                        batch_removed, _ in batch:
+                    trips.extend(batch_trips)
+                    updates.extend(batch_updates)
+                    closes.extend(batch_closes)
+                    removed.extend(batch_removed)
+                try:
+                    if self.pool is not None:
+                        with self.pool.lease():
+                            self.write(trips, updates, closes, removed)
+                    else:
+                        self.write(trips, updates, closes, removed)
+                except:
+                    logger.exception("")
+                    self._retry(batch)
+                    continue
+                self.written += len(batch)
+                self.last_lag = time.time() - batch[0][0]
+                self.max_lag = max(self.max_lag, self.last_lag)
+                logger.debug("Wrote %d snapshots, lag %.3fs, %d pending",
+                             len(batch), self.last_lag, self.pending)
+        finally:
+            # This thread's own database connection
+            connections.close_all()
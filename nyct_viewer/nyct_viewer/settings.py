@@ -77,15 +77,36 @@ WSGI_APPLICATION = 'nyct_viewer.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+NYCT_DATABASE_PROFILES = {
+    'postgresql': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
         'NAME': 'subway',
         'USER': 'subway',
         'PASSWORD': 'subway',
         'HOST': 'localhost',
         'PORT': '',
-    }
+    },
+    # Single node without a database server, in WAL mode, see
+    # nyct_scraper/sqlite_profile.py
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('NYCT_SQLITE_PATH',
+                               os.path.join(BASE_DIR, 'db.sqlite3')),
+        'OPTIONS': {
+            # Seconds to wait for the scraper to release the write lock
+            'timeout': 20,
+        },
+        # On disk rather than in memory, for benchmark_storage
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
+    },
+}
+
+# NYCT_DATABASE=sqlite in the environment selects the SQLite profile
+DATABASES = {
+    'default': NYCT_DATABASE_PROFILES[
+        os.environ.get('NYCT_DATABASE', 'postgresql')],
 }
 
 
@@ -136,3 +157,81 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Raw GTFS-realtime payloads fetched by the scraper are archived here,
+# e.g. os.path.join(BASE_DIR, 'archive'). None disables archiving. The
+# oldest segments are deleted past NYCT_ARCHIVE_MAX_BYTES (None keeps
+# everything).
+NYCT_ARCHIVE_DIR = None
+NYCT_ARCHIVE_MAX_BYTES = 10 * 1024 ** 3
+
+# When set, the scraper replays the payloads archived under this directory
+# instead of polling the MTA, at NYCT_REPLAY_SPEED times real time
+# (None replays as fast as possible).
+NYCT_REPLAY_DIR = None
+NYCT_REPLAY_SPEED = 1.0
+
+# Feed URL template (api key, feed id) polled by the scraper. None polls
+# the MTA; point it at "manage.py serve_feeds" for load and failure tests.
+NYCT_BASEURL = None
+
+# Parse feeds in this many worker processes instead of on the scraper
+# thread. 0 disables the process pool.
+NYCT_PARSE_WORKERS = 0
+
+# Parse feeds into lightweight records, which only become Trip and Update
+# model instances when they are stored.
+NYCT_PARSE_RECORDS = False
+
+# Also parse every feed into NumPy columns, see
+# NYCT_Tracker.snapshot_columns().
+NYCT_PARSE_COLUMNS = False
+
+# Decode feeds with the field-selective wire-format decoder instead of the
+# generated protobuf classes. Ignored with NYCT_PARSE_COLUMNS; check it
+# against the archive with "manage.py check_wire_decoder" first.
+NYCT_PARSE_WIRE = False
+
+# Rows per INSERT statement when the scraper stores a snapshot; the whole
+# snapshot is stored in one transaction.
+NYCT_STORE_BATCH_SIZE = 1000
+
+# Store snapshots with COPY on PostgreSQL. Other databases always use
+# batched INSERTs.
+NYCT_STORE_COPY = True
+
+# On PostgreSQL the trip and update tables are partitioned by retrieval
+# day. "manage.py manage_partitions", run daily, creates partitions this
+# many days ahead and drops those older than NYCT_RETENTION_DAYS (None
+# keeps everything).
+NYCT_PARTITION_DAYS_AHEAD = 7
+NYCT_RETENTION_DAYS = None
+
+# Snapshots are stored synchronously (None). Opt in to storing them on a
+# separate thread, so broadcasts never wait on the database, at the risk
+# of losing snapshots: when NYCT_WRITE_QUEUE snapshots are waiting,
+# 'coalesce' merges new ones into the last waiting one and 'drop_oldest'
+# discards the oldest. Past NYCT_WRITE_ROWS trips and updates waiting
+# (None for 200000), the oldest snapshots are dropped whatever the policy.
+# Failed writes are retried, with backoff, 5 times, then given up.
+NYCT_WRITE_BEHIND = None
+NYCT_WRITE_QUEUE = 8
+NYCT_WRITE_ROWS = None
+
+# Change data capture of predictions: store an update only when its
+# arrival, departure, track or schedule relationship changes, with the
+# interval it holds for (retrieval to valid_until). Prefer 'coalesce'
+# write-behind with it, dropped snapshots leave gaps in the history.
+NYCT_STORE_CDC = False
+
+# Publish scheduled trips missing from the feeds as cancelled. Needs the
+# GTFS schedule (trips, stop_times and calendars) under metadata/.
+NYCT_DETECT_CANCELLATIONS = False
+
+# Database connections of the scraper and write-behind threads, see
+# nyct_scraper/db_pool.py: at most NYCT_DB_POOL_SIZE in use at once, kept
+# across cycles and replaced after NYCT_DB_POOL_MAX_AGE seconds (None keeps
+# them), checked before use when idle for NYCT_DB_POOL_CHECK_INTERVAL.
+NYCT_DB_POOL_SIZE = 2
+NYCT_DB_POOL_MAX_AGE = 3600
+NYCT_DB_POOL_CHECK_INTERVAL = 30
@@ -63,6 +63,9 @@ class RealtimeStreamConsumer(AsyncWebsocketConsumer):
     async def train_status(self, event):
         await self.send(text_data=json.dumps(event))
 
+    async def cancellations(self, event):
+        await self.send(text_data=json.dumps(event))
+
     async def data_request(self, event):
         # Websocket clients (web clients) do not need to respond
         # to other data requests.
@@ -1,5 +1,16 @@
+from django.http import JsonResponse
 from django.shortcuts import render
+from nyct_scraper.models import CurrentTrip
 
 
 def index(request):
     return render(request, 'realtime_stream/index.html', {})
+
+
+def current(request):
+    ''' Latest state of every trip in the feeds, optionally of one route
+    only (?route=) '''
+    trips = CurrentTrip.objects.all()
+    if 'route' in request.GET:
+        trips = trips.filter(route_id=request.GET['route'])
+    return JsonResponse({'trips': [trip.to_dict() for trip in trips]})